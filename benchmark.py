@@ -0,0 +1,343 @@
+"""録音処理のベンチマーク
+
+Discordに接続せずに、合成した複数話者の音声を実際の録音と同じ経路
+（recording_loop → StreamingSink → エンコードキュー → save_recording）へ流し、
+処理性能をJSONで出力する。音声は実時間で流すので、--duration 秒かかる。
+
+使い方:
+    python benchmark.py --guilds 2 --users 4 --duration 60 --segment 20 --output result.json
+
+bot.py と同じく config.py を読み込む（TOKENは使わない）。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import numpy as np
+import discord
+import bot
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FRAME_SAMPLES = bot.SAMPLE_RATE // 50  # 1パケット（20ms）のサンプル数
+FRAME_SECONDS = FRAME_SAMPLES / bot.SAMPLE_RATE
+
+class StubGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"benchmark-{guild_id}"
+
+    def get_member(self, user_id):
+        return None
+
+class StubContext:
+    """コマンドのコンテキストの代わり（送信したメッセージを記録するだけ）"""
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+        self.channel = self  # 通知（bot.notifications）の送信先
+        self.messages = []
+
+    async def send(self, message=None, *, embed=None):
+        self.messages.append(message if embed is None else embed.description)
+
+class SyntheticSpeaker:
+    """1人分の合成音声
+
+    1秒ごとに talk_ratio の確率で話すかどうかを決め、話している間だけ
+    20msごとのパケットを出す（Discordも無音の間はパケットを送らない）。
+    """
+
+    def __init__(self, user_id, ssrc, talk_ratio, rng, encode_opus=False):
+        self.user_id = user_id
+        self.ssrc = ssrc
+        self.talk_ratio = talk_ratio
+        self.rng = rng
+        self.talking_seconds = {}
+        self.timestamp_base = rng.randrange(2 ** 32)
+        # 1秒分のパケットを作っておき、繰り返し使う
+        frequency = rng.uniform(120, 300)
+        t = np.arange(bot.SAMPLE_RATE) / bot.SAMPLE_RATE
+        tone = (np.sin(2 * np.pi * frequency * t) * 0.25 + rng.uniform(0.01, 0.03) * np.sin(7919 * t)) * 32767
+        samples = np.repeat(tone.astype('<i2'), bot.CHANNELS).reshape(-1, FRAME_SAMPLES * bot.CHANNELS)
+        self.frames = [frame.tobytes() for frame in samples]
+        self.packets = None
+        if encode_opus:
+            encoder = discord.opus.Encoder()
+            self.packets = [encoder.encode(frame, FRAME_SAMPLES) for frame in self.frames]
+
+    def talking(self, frame):
+        second = frame // 50
+        talking = self.talking_seconds.get(second)
+        if talking is None:
+            talking = self.talking_seconds[second] = self.rng.random() < self.talk_ratio
+        return talking
+
+    def packet(self, frame):
+        """(PCM, Opusパケット（無い場合はNone）, RTPタイムスタンプ)"""
+        index = frame % len(self.frames)
+        packet = self.packets[index] if self.packets is not None else None
+        return self.frames[index], packet, (self.timestamp_base + frame * FRAME_SAMPLES) & 0xFFFFFFFF
+
+class StubVoiceClient:
+    """録音に必要な部分だけを持つVoiceClientの代わり
+
+    start_recording() で送信スレッドを起動し、20msごとに合成したパケットを
+    RecorderVoiceClient と同じ処理でシンクへ渡す。
+    """
+
+    def __init__(self, guild, speakers):
+        self.guild = guild
+        self.channel = types.SimpleNamespace(id=guild.id, name="benchmark", members=[], voice_states={})
+        self.speakers = speakers
+        self.ws = types.SimpleNamespace(ssrc_map={speaker.ssrc: {"user_id": speaker.user_id, "speaking": True}
+                                                  for speaker in speakers})
+        self.sink = None
+        self.recording = False
+        self.decoders = {}
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return False
+
+    def start_recording(self, sink, callback, *args):
+        self.sink = sink
+        sink.init(self)
+        self.recording = True
+        self._thread = threading.Thread(target=self._feed, name="benchmark-feed", daemon=True)
+        self._thread.start()
+
+    def stop_recording(self):
+        self.recording = False
+        self._stop.set()
+        self._thread.join()
+        self.stopped_at = time.perf_counter()
+        self.sink.cleanup()
+
+    async def disconnect(self):
+        pass
+
+    def _feed(self):
+        self.started_at = time.perf_counter()
+        frame = 0
+        while True:
+            delay = self.started_at + frame * FRAME_SECONDS - time.perf_counter()
+            if self._stop.wait(max(0.0, delay)):
+                return
+            for speaker in self.speakers:
+                if not speaker.talking(frame):
+                    continue
+                pcm, packet, timestamp = speaker.packet(frame)
+                if self.sink.passthrough:
+                    # RecorderVoiceClient.unpack_audio の復号後と同じ処理
+                    bot.metrics.inc("recorder_packets_received_total", guild=str(self.guild.id))
+                    self.sink.write_opus(speaker.user_id, packet, time.perf_counter(), timestamp)
+                    continue
+                if packet is not None:
+                    # 実際の受信と同じく、Opusをデコードしてから渡す
+                    decoder = self.decoders.get(speaker.ssrc)
+                    if decoder is None:
+                        decoder = self.decoders[speaker.ssrc] = discord.opus.Decoder()
+                    pcm = decoder.decode(packet)
+                data = types.SimpleNamespace(ssrc=speaker.ssrc, decoded_data=pcm, receive_time=time.perf_counter(),
+                                             timestamp=timestamp, decrypted_data=packet)
+                bot.RecorderVoiceClient.recv_decoded_audio(self, data)
+            frame += 1
+
+async def run_guild(guild_id, args, root, rng):
+    """1サーバー分の録音を --duration 秒だけ行う"""
+    guild = StubGuild(guild_id)
+    ctx = StubContext(guild)
+    speakers = [SyntheticSpeaker(guild_id * 100 + index, 1000 + index, args.talk_ratio,
+                                 random.Random(rng.random()), encode_opus=args.opus)
+                for index in range(args.users)]
+    voice_client = StubVoiceClient(guild, speakers)
+    session_dir = os.path.join(root, str(guild_id))
+    os.makedirs(session_dir, exist_ok=True)
+    session = bot.RecordingSession(ctx, voice_client, session_dir, multitrack=args.multitrack)
+    bot.recording_sessions.add(session)
+    task = asyncio.create_task(bot.recording_loop(session))
+    await asyncio.sleep(args.duration)
+    await bot.stop_session(guild_id)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return session, voice_client.stopped_at - voice_client.started_at
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+async def run_benchmark(args):
+    bot.RECORDING_LENGTH = args.segment
+    if args.silence_window is not None:
+        bot.SEGMENT_SILENCE_WINDOW = args.silence_window
+    bot.NORMALIZE_LOUDNESS = bot.NORMALIZE_LOUDNESS or args.normalize
+    if args.format is not None:
+        bot.OUTPUT_FORMAT = args.format
+        bot.OUTPUT_EXT = bot.OUTPUT_FORMATS[args.format][0]
+    root = tempfile.mkdtemp(prefix="recorder-benchmark-", dir=args.workdir)
+    rng = random.Random(args.seed)
+    bot.catalog = bot.RecordingCatalog(os.path.join(root, "catalog.sqlite3"))
+
+    bot.encode_queue.start()
+    bot.monitor_event_loop.start()
+    before = os.times()
+    wall_start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(run_guild(index + 1, args, root, rng) for index in range(args.guilds)))
+        await bot.encode_queue.queue.join()
+        wall_seconds = time.perf_counter() - wall_start
+        after = os.times()
+        output_bytes = directory_size(root)
+    finally:
+        bot.monitor_event_loop.cancel()
+        if args.keep:
+            print(f"出力を残しました: {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    audio_seconds = sum(seconds for _, seconds in results)
+    process_cpu = (after.user - before.user) + (after.system - before.system)
+    ffmpeg_cpu = (after.children_user - before.children_user) + (after.children_system - before.children_system)
+    losses = [loss for session, _ in results for loss in session.boundary_loss_ms]
+    samples = bot.metrics.samples()
+
+    def total(name):
+        return sum(value for sample_name, _, value in samples if sample_name == name)
+
+    def summarize(values):
+        return {
+            "max": max(values) if values else None,
+            "mean": sum(values) / len(values) if values else None,
+            "total": sum(values),
+        }
+
+    def mean(name):
+        count, value_sum = bot.metrics.histogram_summary(name)
+        return value_sum / count if count else None
+
+    encode_jobs, _ = bot.metrics.histogram_summary("recorder_encode_seconds")
+    loop_lag = mean("recorder_event_loop_lag_seconds")
+    ffmpeg_rss = mean("recorder_ffmpeg_peak_rss_bytes")
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "guilds": args.guilds,
+            "users": args.users,
+            "duration": args.duration,
+            "segment": args.segment,
+            "talk_ratio": args.talk_ratio,
+            "opus": args.opus,
+            "multitrack": args.multitrack,
+            "output_format": bot.OUTPUT_FORMAT,
+            "mix_mode": bot.MIX_MODE,
+            "silence_trim": bot.SILENCE_TRIM,
+            "silence_window": bot.SEGMENT_SILENCE_WINDOW,
+            "normalize_loudness": bot.NORMALIZE_LOUDNESS,
+            "spool": bot.SPOOL_ENABLED,
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "py-cord": discord.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "audio_seconds": audio_seconds,
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": {"bot": process_cpu, "ffmpeg": ffmpeg_cpu, "total": process_cpu + ffmpeg_cpu},
+        "audio_seconds_per_cpu_second": audio_seconds / (process_cpu + ffmpeg_cpu) if process_cpu + ffmpeg_cpu else None,
+        # ffmpegはプロセスごとの最大使用メモリの平均（RUSAGE_CHILDREN はexec前のPythonのメモリを含むので使わない）
+        "peak_rss_mb": {"bot": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+                        "ffmpeg_per_process": ffmpeg_rss / 1024 ** 2 if ffmpeg_rss is not None else None},
+        # 区切りの前後で捨てた音声と、次のセグメントの先頭に寄せた音声（区切りと関係ない欠落は dropped_frames）
+        "boundary_loss_ms": {
+            "count": len(losses),
+            "dropped": summarize([dropped for dropped, _ in losses]),
+            "shifted": summarize([shifted for _, shifted in losses]),
+        },
+        "packets_received": total("recorder_packets_received_total"),
+        "dropped_frames": total("recorder_dropped_frames_total"),
+        "encode": {
+            "jobs": encode_jobs,
+            "mean_wait_seconds": mean("recorder_encode_wait_seconds"),
+            "mean_seconds": mean("recorder_encode_seconds"),
+            "ffmpeg_mean_wall_seconds": mean("recorder_ffmpeg_wall_seconds"),
+        },
+        "event_loop_lag_ms": loop_lag * 1000 if loop_lag is not None else None,
+        "output_bytes": output_bytes,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="合成した音声で録音処理のベンチマークを行い、結果をJSONで出力します")
+    parser.add_argument("--guilds", type=int, default=1, help="同時に録音するサーバー数")
+    parser.add_argument("--users", type=int, default=4, help="1サーバーあたりの話者数")
+    parser.add_argument("--duration", type=float, default=60, help="録音する長さ（秒、実時間）")
+    parser.add_argument("--segment", type=float, default=20, help="セグメントの長さ（秒）")
+    parser.add_argument("--silence-window", type=float,
+                        help="SEGMENT_SILENCE_WINDOW を上書きする（0ならセグメントの長さちょうどで区切る）")
+    parser.add_argument("--normalize", action="store_true", help="話者ごとの音量を揃える（NORMALIZE_LOUDNESS）")
+    parser.add_argument("--talk-ratio", type=float, default=0.5, help="各話者が話している時間の割合")
+    parser.add_argument("--opus", action="store_true", help="Opusにエンコードしたパケットを流す（libopusが必要）")
+    parser.add_argument("--multitrack", action="store_true", help="ユーザーごとに別ファイルで録音する")
+    parser.add_argument("--format", choices=sorted(bot.OUTPUT_FORMATS), help="OUTPUT_FORMAT を上書きする")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--workdir", help="一時的な出力先を作るディレクトリ")
+    parser.add_argument("--keep", action="store_true", help="出力されたファイルを削除しない")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--verbose", action="store_true", help="録音処理のログを表示する")
+    args = parser.parse_args()
+
+    if args.multitrack and (args.format or bot.OUTPUT_FORMAT) == "opus" and bot.OPUS_PASSTHROUGH and not args.opus:
+        parser.error("Opusのパススルーを測るには --opus が必要です")
+    if args.opus and not discord.opus.is_loaded():
+        try:
+            discord.opus._load_default()
+        except Exception:
+            pass
+        if not discord.opus.is_loaded():
+            parser.error("libopusが読み込めません")
+    if not args.verbose:
+        bot.logger.setLevel(logging.WARNING)
+
+    result = asyncio.run(run_benchmark(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 """
 Discord録音ボット
 
-Discordの音声チャンネルでの会話を自動的に録音し、MP3ファイルとして保存します。
+Discordの音声チャンネルでの会話を自動的に録音し、MP3（設定によりOpus・FLAC・WAV）ファイルとして保存します。
 10分ごとに録音ファイルを区切るため、長時間の録音でも管理しやすくなっています。
 """
 
@@ -11,21 +11,123 @@ import os
 import datetime
 import wave
 import logging
+import logging.handlers
+import queue
+import atexit
 import subprocess
 import tempfile
+import time
+import itertools
+import json
+import glob
+import struct
+import threading
+import collections
+import concurrent.futures
+import importlib.util
+import multiprocessing
+import sys
+import random
+import re
+import sqlite3
+from multiprocessing.connection import Listener, Client
+import numpy as np
 from discord.ext import commands, tasks
+import config
 from config import TOKEN, COMMAND_PREFIX, RECORDING_LENGTH, SAMPLE_RATE, CHANNELS
 
+BOOT_STARTED = time.perf_counter()  # 起動にかかった時間の計測用
+
+# 任意の設定（古いconfig.pyでも動くようにデフォルト値を用意）
+MAX_CONCURRENT_ENCODES = getattr(config, 'MAX_CONCURRENT_ENCODES', 2)  # 同時に実行するエンコード数
+ENCODE_QUEUE_SIZE = getattr(config, 'ENCODE_QUEUE_SIZE', 8)  # エンコード待ちキューの上限
+MIX_MODE = getattr(config, 'MIX_MODE', 'clip')  # 'clip' または 'normalize'
+SILENCE_TRIM = getattr(config, 'SILENCE_TRIM', False)  # 長い無音区間を詰める
+SILENCE_THRESHOLD_DB = getattr(config, 'SILENCE_THRESHOLD_DB', -50)  # これより小さい音量を無音とみなす（dBFS）
+SILENCE_KEEP_SECONDS = getattr(config, 'SILENCE_KEEP_SECONDS', 1.0)  # 詰めるときに残す無音の長さ（秒）
+SKIP_SILENT_SEGMENTS = getattr(config, 'SKIP_SILENT_SEGMENTS', True)  # 無音だけのセグメントは保存しない
+SEGMENT_SILENCE_WINDOW = getattr(config, 'SEGMENT_SILENCE_WINDOW', 30)  # 区切りの時刻の前後この範囲（秒）で無音を探して区切る（0なら時刻ちょうど）
+SEGMENT_SILENCE_GAP = getattr(config, 'SEGMENT_SILENCE_GAP', 0.7)  # 全員がこの長さ（秒）話していなければ無音とみなす
+SEGMENT_MAX_BYTES = getattr(config, 'SEGMENT_MAX_BYTES', None)  # セグメントのPCMがこのバイト数に達したら区切る（Noneなら無制限）
+NORMALIZE_LOUDNESS = getattr(config, 'NORMALIZE_LOUDNESS', False)  # 話者ごとの音量を揃える
+LOUDNESS_TARGET = getattr(config, 'LOUDNESS_TARGET', -23.0)  # 目標のラウドネス（LUFS）
+LOUDNESS_MAX_GAIN_DB = getattr(config, 'LOUDNESS_MAX_GAIN_DB', 12.0)  # 上げ下げするゲインの上限（dB）
+OUTPUT_FORMAT = getattr(config, 'OUTPUT_FORMAT', 'mp3')  # 'mp3' / 'opus' / 'flac' / 'wav'
+OPUS_PASSTHROUGH = getattr(config, 'OPUS_PASSTHROUGH', True)  # マルチトラックのOpusは受信したパケットをそのまま保存
+DEBUG_CAPTURE = getattr(config, 'DEBUG_CAPTURE', False)  # 全サーバーでデバッグ用WAVを保存する
+DEBUG_CAPTURE_GUILDS = getattr(config, 'DEBUG_CAPTURE_GUILDS', [])  # デバッグ用WAVを保存するサーバーID
+DEBUG_MAX_FILES = getattr(config, 'DEBUG_MAX_FILES', 20)  # デバッグ用WAVの最大ファイル数
+DEBUG_MAX_BYTES = getattr(config, 'DEBUG_MAX_BYTES', 2 * 1024 ** 3)  # デバッグ用WAVの最大合計サイズ
+SPOOL_ENABLED = getattr(config, 'SPOOL_ENABLED', True)  # 受信したOpusパケットをディスクにも書き出す（クラッシュ時の復旧用）
+SPOOL_FSYNC_INTERVAL = getattr(config, 'SPOOL_FSYNC_INTERVAL', 5)  # スプールをディスクへ確実に書き込む間隔（秒）
+SHARD_COUNT = getattr(config, 'SHARD_COUNT', 1)  # 録音プロセスの数（1なら従来どおり1プロセスで動かす）
+HEALTH_REPORT_INTERVAL = getattr(config, 'HEALTH_REPORT_INTERVAL', 10)  # 各プロセスが状態を報告する間隔（秒）
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)  # Prometheus形式のメトリクスを公開するポート（Noneなら公開しない）
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')  # メトリクスを公開するアドレス
+PROFILE_ENCODES = getattr(config, 'PROFILE_ENCODES', False)  # 保存・エンコード中のスタックを記録する
+PROFILE_INTERVAL = getattr(config, 'PROFILE_INTERVAL', 0.005)  # スタックを記録する間隔（秒）
+RECONNECT_ATTEMPTS = getattr(config, 'RECONNECT_ATTEMPTS', 8)  # 録音が中断されたときに復旧を試みる回数
+RECONNECT_BASE_DELAY = getattr(config, 'RECONNECT_BASE_DELAY', 1.0)  # 2回目の再試行までの待ち時間（秒、以降は倍々）
+RECONNECT_MAX_DELAY = getattr(config, 'RECONNECT_MAX_DELAY', 30.0)  # 再試行の待ち時間の上限（秒）
+RECONNECT_WAIT = getattr(config, 'RECONNECT_WAIT', 10.0)  # py-cord自身の再接続を待つ時間（秒）
+LIVE_PORT = getattr(config, 'LIVE_PORT', None)  # 録音中のミックスを配信するポート（Noneなら配信しない）
+LIVE_HOST = getattr(config, 'LIVE_HOST', '127.0.0.1')  # 配信するアドレス
+LIVE_BUFFER_SECONDS = getattr(config, 'LIVE_BUFFER_SECONDS', 10)  # 配信用に保持する長さ（秒）
+TRANSCRIBE = getattr(config, 'TRANSCRIBE', False)  # 保存したセグメントを文字起こしする（faster-whisper が必要）
+TRANSCRIBE_MODEL = getattr(config, 'TRANSCRIBE_MODEL', 'small')  # faster-whisper のモデル名またはパス
+TRANSCRIBE_LANGUAGE = getattr(config, 'TRANSCRIBE_LANGUAGE', 'ja')  # 言語（Noneなら自動判定）
+TRANSCRIBE_WORKERS = getattr(config, 'TRANSCRIBE_WORKERS', 1)  # 文字起こしのワーカープロセス数
+TRANSCRIBE_THREADS = getattr(config, 'TRANSCRIBE_THREADS', 2)  # ワーカー1つあたりのCPUスレッド数
+TRANSCRIBE_NICE = getattr(config, 'TRANSCRIBE_NICE', 19)  # ワーカーの nice 値（録音より優先度を下げる）
+TRANSCRIBE_BATCH_SIZE = getattr(config, 'TRANSCRIBE_BATCH_SIZE', 8)  # 1回にまとめて渡すセグメント数
+TRANSCRIBE_BATCH_WAIT = getattr(config, 'TRANSCRIBE_BATCH_WAIT', 30)  # バッチが揃うのを待つ時間（秒）
+TRANSCRIBE_QUEUE_SIZE = getattr(config, 'TRANSCRIBE_QUEUE_SIZE', 100)  # 文字起こし待ちの上限（超えたらスキップ）
+LEAN_STARTUP = getattr(config, 'LEAN_STARTUP', True)  # 録音に必要なインテントとボイスチャンネルのメンバーだけをキャッシュする
+LOG_MAX_BYTES = getattr(config, 'LOG_MAX_BYTES', 10 * 1024 ** 2)  # ログファイルを切り替えるサイズ（バイト）
+LOG_BACKUP_COUNT = getattr(config, 'LOG_BACKUP_COUNT', 5)  # 残す古いログファイルの数
+NOTIFY_INTERVAL = getattr(config, 'NOTIFY_INTERVAL', 2.0)  # チャンネルへの通知をまとめる間隔（秒）
+NOTIFY_MAX_PENDING = getattr(config, 'NOTIFY_MAX_PENDING', 100)  # チャンネルごとの未送信の通知の上限
+CATALOG_PATH = getattr(config, 'CATALOG_PATH', None)  # 録音の目録（SQLite）の保存先（Noneなら recordings/catalog.sqlite3）
+
+# シャーディング時は、スーパーバイザーが担当シャードと制御チャネルを環境変数で渡す
+SHARD_ID = int(os.environ["RECORDER_SHARD_ID"]) if "RECORDER_SHARD_ID" in os.environ else None
+
+# 出力形式ごとの拡張子とFFmpegのエンコード設定（wavはFFmpegを使わず直接書き出す）
+OUTPUT_FORMATS = {
+    'mp3': ('.mp3', ['-codec:a', 'libmp3lame', '-qscale:a', '2']),  # 品質設定 (0-9, 0が最高品質)
+    'opus': ('.ogg', ['-codec:a', 'libopus', '-b:a', '64k']),
+    'flac': ('.flac', ['-codec:a', 'flac']),
+    'wav': ('.wav', None),
+}
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    raise ValueError(f"OUTPUT_FORMAT は {', '.join(OUTPUT_FORMATS)} のいずれかを指定してください: {OUTPUT_FORMAT}")
+OUTPUT_EXT = OUTPUT_FORMATS[OUTPUT_FORMAT][0]
+
 # ロガーの設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("discord-recorder")
+# イベントループ上ではキューに積むだけにし、ファイルへの書き込みは QueueListener のスレッドで行う
+log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [logging.StreamHandler()]
+if multiprocessing.parent_process() is None:
+    # 文字起こしのワーカープロセスはログファイルに書かない（切り替えが競合するため）
+    log_suffix = "" if SHARD_ID is None else f".shard{SHARD_ID}"
+    log_handlers.append(logging.handlers.RotatingFileHandler(
+        f"bot{log_suffix}.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'))
+    # on_error の記録は err.log にも書き出す
+    error_handler = logging.handlers.RotatingFileHandler(
+        f"err{log_suffix}.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    error_handler.addFilter(lambda record: record.name == "discord-recorder.errors")
+    log_handlers.append(error_handler)
+for handler in log_handlers:
+    handler.setFormatter(log_format)
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))  # 書式は各ハンドラーで付ける
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+logger = logging.getLogger("discord-recorder" if SHARD_ID is None else f"discord-recorder.shard{SHARD_ID}")
+error_logger = logging.getLogger("discord-recorder.errors")
 
 # スクリプトのディレクトリを取得（絶対パス用）
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -34,396 +136,3144 @@ RECORDINGS_DIR = os.path.join(SCRIPT_DIR, "recordings")
 # FFmpegへのパスを設定（ローカルにある場合）
 FFMPEG_PATH = os.path.join(SCRIPT_DIR, "ffmpeg.exe")
 
-# ボットのインテント設定
-intents = discord.Intents.all()  # すべてのインテントを有効化
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+# ボットのインテント設定
+if LEAN_STARTUP:
+    # 録音に使わないメンバー一覧・プレゼンス・メッセージはキャッシュしない
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True  # コマンドの受信に必要
+    intents.message_content = True
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True  # ボイスチャンネルにいるメンバーだけ
+    cache_options = {"member_cache_flags": member_cache_flags, "chunk_guilds_at_startup": False, "max_messages": None}
+else:
+    intents = discord.Intents.all()  # すべてのインテントを有効化
+    cache_options = {}
+shard_options = {} if SHARD_ID is None else {"shard_id": SHARD_ID, "shard_count": SHARD_COUNT}
+bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, **cache_options, **shard_options)
+
+class RecordingSession:
+    """1サーバー分の録音セッション
+
+    状態は次のように移る。停止（stopping）は一度しか行われないので、
+    !stop・全員の退出・再接続の失敗が重なっても二重に停止しない。
+
+        recording <-> rotating（セグメントの区切り）
+        recording / rotating -> stopping -> encoding（最後のセグメントを変換中） -> stopped
+    """
+
+    __slots__ = ("guild_id", "channel_id", "ctx", "voice_client", "session_dir", "segment",
+                 "multitrack", "sink", "boundary_loss_ms", "state", "reconnecting", "wakeup", "cut_requested")
+
+    RECORDING = "recording"
+    ROTATING = "rotating"
+    STOPPING = "stopping"
+    ENCODING = "encoding"
+    STOPPED = "stopped"
+    TRANSITIONS = {
+        RECORDING: {ROTATING, STOPPING},
+        ROTATING: {RECORDING, STOPPING},
+        STOPPING: {ENCODING},
+        ENCODING: {STOPPED},
+        STOPPED: set(),
+    }
+
+    def __init__(self, ctx, voice_client, session_dir, multitrack=False):
+        self.guild_id = ctx.guild.id
+        self.channel_id = voice_client.channel.id
+        self.ctx = ctx
+        self.voice_client = voice_client
+        self.session_dir = session_dir
+        self.segment = 1
+        self.multitrack = multitrack
+        self.sink = None  # StreamingSink（録音ループが作成）
+        self.boundary_loss_ms = []  # セグメントの区切りごとの (捨てた音声, 先頭に寄せた音声) の長さ（変換が終わった順）
+        self.state = self.RECORDING
+        self.reconnecting = False  # supervise_connection が復旧中か
+        self.wakeup = asyncio.Event()  # 停止したときに待機中の処理を起こす
+        self.cut_requested = asyncio.Event()  # セグメントがサイズの上限に達したときに録音ループを起こす
+
+    @property
+    def active(self):
+        """録音を続けている状態か"""
+        return self.state in (self.RECORDING, self.ROTATING)
+
+    def transition(self, state):
+        """状態を移す。今の状態から移れない場合は何もせずFalseを返す"""
+        if state not in self.TRANSITIONS[self.state]:
+            return False
+        self.state = state
+        if state == self.STOPPING:
+            self.wakeup.set()
+        return True
+
+    async def wait(self, timeout, cut=False):
+        """timeout 秒待つ。その間に停止された場合（cut=True なら区切りを求められた場合も）はすぐに戻る"""
+        if not cut:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+            return
+        waiters = [asyncio.ensure_future(self.wakeup.wait()), asyncio.ensure_future(self.cut_requested.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+class SessionRegistry:
+    """録音セッションをサーバーIDと音声チャンネルIDの両方で引けるようにする
+
+    音声状態の更新は全サーバーの全チャンネルについて届くので、
+    録音していないチャンネルの更新は辞書を1回引くだけで済ませる。
+    """
+
+    def __init__(self):
+        self.by_guild = {}
+        self.by_channel = {}
+
+    def __contains__(self, guild_id):
+        return guild_id in self.by_guild
+
+    def __len__(self):
+        return len(self.by_guild)
+
+    def get(self, guild_id):
+        return self.by_guild.get(guild_id)
+
+    def for_channel(self, channel_id):
+        return self.by_channel.get(channel_id)
+
+    def values(self):
+        """セッションの一覧（コピーなので走査中に追加・削除してもよい）"""
+        return list(self.by_guild.values())
+
+    def add(self, session):
+        self.by_guild[session.guild_id] = session
+        self.by_channel[session.channel_id] = session
+
+    def move(self, session, channel_id):
+        """ボットが別のチャンネルへ移された場合に索引を付け替える"""
+        if self.by_channel.get(session.channel_id) is session:
+            del self.by_channel[session.channel_id]
+        session.channel_id = channel_id
+        self.by_channel[channel_id] = session
+
+    def remove(self, session):
+        if self.by_guild.get(session.guild_id) is session:
+            del self.by_guild[session.guild_id]
+        if self.by_channel.get(session.channel_id) is session:
+            del self.by_channel[session.channel_id]
+
+# 録音中のセッション
+recording_sessions = SessionRegistry()
+
+# デバッグ用WAVを保存するサーバー（!debug で切り替え）
+debug_capture_guilds = set(DEBUG_CAPTURE_GUILDS)
+DEBUG_DIR = os.path.join(RECORDINGS_DIR, "debug")
+PROFILE_DIR = os.path.join(RECORDINGS_DIR, "profiles")
+
+# --- メトリクス（!metrics と METRICS_PORT のHTTPエンドポイントで確認できる） ---
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5)
+MEMORY_BUCKETS = tuple(size * 1024 ** 2 for size in (8, 16, 32, 64, 128, 256, 512))
+
+# 名前 -> (種類, 説明, ヒストグラムのバケット)
+METRIC_DEFINITIONS = {
+    "recorder_packets_received_total": ("counter", "受信した音声パケット数", None),
+    "recorder_packets_dropped_total": ("counter", "誰のものか分からず捨てた音声パケット数", None),
+    "recorder_dropped_frames_total": ("counter", "合成時に遅れて届いた・バッファに収まらなかったため捨てたフレーム数", None),
+    "recorder_buffered_bytes": ("gauge", "合成バッファに溜まっている未出力のPCM（バイト）", None),
+    "recorder_sink_memory_bytes": ("gauge", "録音中・変換待ちのセグメントが確保している合成バッファ（バイト）", None),
+    "recorder_encode_queue_jobs": ("gauge", "エンコードキューのジョブ数", None),
+    "recorder_encode_wait_seconds": ("histogram", "エンコードジョブがキューで待った時間（秒）", LATENCY_BUCKETS),
+    "recorder_encode_seconds": ("histogram", "エンコードジョブの処理時間（秒）", LATENCY_BUCKETS),
+    "recorder_ffmpeg_wall_seconds": ("histogram", "ffmpegの起動から終了までの時間（秒）", LATENCY_BUCKETS),
+    "recorder_ffmpeg_cpu_seconds": ("histogram", "ffmpegが消費したCPU時間（秒）", LATENCY_BUCKETS),
+    "recorder_ffmpeg_peak_rss_bytes": ("histogram", "ffmpeg 1プロセスの最大使用メモリ（バイト）", MEMORY_BUCKETS),
+    "recorder_event_loop_lag_seconds": ("histogram", "イベントループの遅れ（秒）", LOOP_LAG_BUCKETS),
+    "recorder_reconnects_total": ("counter", "音声チャンネルへの再接続の回数", None),
+    "recorder_transcriptions_total": ("counter", "文字起こししたセグメント数", None),
+}
+
+def metric_guild(guild):
+    """メトリクスのラベルに使うサーバーID"""
+    return str(guild.id) if guild is not None else "none"
+
+class Metrics:
+    """Prometheusのテキスト形式で出力できるメトリクスの集計
+
+    値はメトリクス名とラベルの組ごとに持つ。受信スレッドやエンコードの
+    スレッドからも更新されるのでロックで保護する。
+    録音中のバッファ量のような現在値は、出力時に collectors の関数で集める。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (名前, ラベル) -> 値
+        self.histograms = {}  # (名前, ラベル) -> [バケットごとの件数, 合計, 件数]
+        self.collectors = []  # (名前, ラベルの辞書, 値) を返す関数
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def samples(self):
+        """現在の値を (名前, ラベルの辞書, 値) の一覧で返す（ヒストグラムは含まない）"""
+        with self.lock:
+            samples = [(name, dict(labels), value) for (name, labels), value in self.values.items()]
+        for collector in self.collectors:
+            samples.extend(collector())
+        return samples
+
+    def histogram_summary(self, name, **labels):
+        """(件数, 合計) を返す。labels に一致するものを合算する"""
+        count, total = 0, 0.0
+        with self.lock:
+            for (key_name, key_labels), (_, value_sum, value_count) in self.histograms.items():
+                if key_name == name and labels.items() <= dict(key_labels).items():
+                    count += value_count
+                    total += value_sum
+        return count, total
+
+    def render(self):
+        """Prometheusのテキスト形式"""
+        by_name = {}
+        for name, labels, value in self.samples():
+            by_name.setdefault(name, []).append((labels, value))
+        with self.lock:
+            histograms = [(name, dict(labels), list(counts), value_sum, value_count)
+                          for (name, labels), (counts, value_sum, value_count) in self.histograms.items()]
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for labels, value in by_name.get(name, []):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            for hist_name, labels, counts, value_sum, value_count in histograms:
+                if hist_name != name:
+                    continue
+                for bound, count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{format_labels(dict(labels, le=str(bound)))} {count}")
+                lines.append(f"{name}_bucket{format_labels(dict(labels, le='+Inf'))} {value_count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value_sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {value_count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+def collect_buffer_metrics():
+    """録音中・変換待ちのセグメントが持つバッファ量とキューの状態"""
+    buffered = {}
+    memory = {}
+    streams = [session.sink.stream for session in recording_sessions.values() if session.sink is not None]
+    streams += [job.stream for job in list(encode_queue.jobs.values())]
+    for stream in streams:
+        guild = metric_guild(stream.guild)
+        for mixer, _, _ in list(stream.outputs.values()):
+            buffered[guild] = buffered.get(guild, 0) + max(0, mixer.written_end - mixer.flushed) * FRAME_BYTES
+            memory[guild] = memory.get(guild, 0) + mixer.buffer.nbytes
+    samples = [("recorder_buffered_bytes", {"guild": guild}, value) for guild, value in buffered.items()]
+    samples += [("recorder_sink_memory_bytes", {"guild": guild}, value) for guild, value in memory.items()]
+    for state in ("queued", "running"):
+        count = sum(1 for job in list(encode_queue.jobs.values()) if job.status == state)
+        samples.append(("recorder_encode_queue_jobs", {"state": state}, count))
+    return samples
+
+metrics.collectors.append(collect_buffer_metrics)
+
+@tasks.loop(seconds=1)
+async def monitor_event_loop():
+    """1秒ごとに起きる予定からの遅れをイベントループの遅延として記録する"""
+    now = time.monotonic()
+    if monitor_event_loop.last_tick is not None:
+        lag = max(0.0, now - monitor_event_loop.last_tick - 1)
+        monitor_event_loop.lag = lag
+        metrics.observe("recorder_event_loop_lag_seconds", lag)
+    monitor_event_loop.last_tick = now
+
+monitor_event_loop.last_tick = None
+monitor_event_loop.lag = None
+
+async def start_metrics_server():
+    """METRICS_PORT でPrometheus形式のメトリクスを公開する（シャードごとにポートをずらす）"""
+    from aiohttp import web
+    
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = METRICS_PORT + (SHARD_ID or 0)
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"メトリクスを公開しました: http://{METRICS_HOST}:{port}/metrics")
+
+class SamplingProfiler:
+    """一定間隔で全スレッドのスタックを記録する簡易サンプリングプロファイラ
+
+    保存・エンコード処理はイベントループ、変換用のスレッド、各セグメントの
+    書き出しスレッドにまたがるので、スレッドを限定せずに記録する。
+    結果は flamegraph.pl などで読める collapsed 形式（1行に「スタック 回数」）。
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or PROFILE_INTERVAL
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self, filename):
+        """記録を止めて結果を書き出す"""
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        logger.info(f"プロファイルを保存しました: {filename}（{sum(self.stacks.values())}サンプル）")
+
+class EncodeJob:
+    """エンコード待ちの1セグメント分のジョブ"""
+
+    def __init__(self, job_id, stream, filename, label, on_done=None):
+        self.id = job_id
+        self.stream = stream
+        self.filename = filename
+        self.label = label
+        self.on_done = on_done  # 完了時に success を渡して呼ぶコルーチン関数
+        self.status = "queued"  # queued / running / done / failed
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.future = asyncio.get_running_loop().create_future()
+
+class EncodeQueue:
+    """セグメントの変換をイベントループの外で順番に処理するキュー
+
+    キューが満杯の場合は submit() が空きを待つ（バックプレッシャー）。
+    同時に走るエンコード数はワーカー数で制限する。
+    """
+
+    def __init__(self, maxsize, concurrency):
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self.queue = None
+        self.workers = []
+        self.jobs = {}  # 待機中・実行中のジョブ
+        self._ids = itertools.count(1)
+
+    def start(self):
+        """ワーカーを起動する（二重起動しない）"""
+        if self.workers:
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        for index in range(self.concurrency):
+            self.workers.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"エンコードワーカーを{self.concurrency}個起動しました（キュー上限: {self.maxsize}）")
+
+    async def submit(self, stream, filename, label, on_done=None):
+        """セグメント（SegmentStream）をキューに渡す。満杯の場合は空くまで待つ"""
+        self.start()
+        job = EncodeJob(next(self._ids), stream, filename, label, on_done)
+        if self.queue.full():
+            logger.warning(f"エンコードキューが満杯です。空きを待ちます: {label}")
+        self.jobs[job.id] = job
+        await self.queue.put(job)
+        logger.info(f"エンコードジョブ#{job.id}を登録しました: {label}（待機数: {self.queue.qsize()}）")
+        return job
+
+    async def _worker(self, index):
+        while True:
+            job = await self.queue.get()
+            job.status = "running"
+            job.started_at = time.monotonic()
+            profiler = SamplingProfiler() if PROFILE_ENCODES else None
+            if profiler is not None:
+                profiler.start()
+            try:
+                success = await save_recording(job.stream, job.filename)
+            except Exception as e:
+                logger.error(f"エンコードジョブ#{job.id}でエラーが発生しました: {e}")
+                success = False
+            job.finished_at = time.monotonic()
+            if profiler is not None:
+                stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                await asyncio.get_running_loop().run_in_executor(
+                    None, profiler.stop, os.path.join(PROFILE_DIR, f"encode_{stamp}_job{job.id}.txt"))
+            guild = metric_guild(job.stream.guild)
+            metrics.observe("recorder_encode_wait_seconds", job.started_at - job.created_at, guild=guild)
+            metrics.observe("recorder_encode_seconds", job.finished_at - job.started_at, guild=guild)
+            job.status = "done" if success else "failed"
+            if success and TRANSCRIBE and not job.stream.is_silent and job.stream.partial is None:
+                transcription_queue.submit(job.stream, job.filename)
+            logger.info(f"エンコードジョブ#{job.id}が終了しました: {job.status} "
+                        f"(待機 {job.started_at - job.created_at:.1f}秒, 処理 {job.finished_at - job.started_at:.1f}秒)")
+            if not job.future.done():
+                job.future.set_result(success)
+            if job.on_done is not None:
+                try:
+                    await job.on_done(success)
+                except Exception as e:
+                    logger.error(f"エンコード完了通知でエラーが発生しました: {e}")
+            self.jobs.pop(job.id, None)
+            self.queue.task_done()
+
+    def describe(self):
+        """状態表示用の文字列"""
+        running = sum(1 for job in self.jobs.values() if job.status == "running")
+        queued = sum(1 for job in self.jobs.values() if job.status == "queued")
+        return f"エンコード中 {running}/{self.concurrency}, 待機 {queued}/{self.maxsize}"
+
+encode_queue = EncodeQueue(ENCODE_QUEUE_SIZE, MAX_CONCURRENT_ENCODES)
+
+# 文字起こしのワーカープロセスで読み込んだモデル
+_whisper_model = None
+
+def lower_priority(niceness):
+    """このプロセスの優先度を下げる（Windowsには nice が無いので優先度クラスで代用する）"""
+    if hasattr(os, 'nice'):
+        os.nice(niceness)
+    elif sys.platform == 'win32' and niceness > 0:
+        import ctypes
+        IDLE_PRIORITY_CLASS = 0x00000040
+        BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
+        priority = IDLE_PRIORITY_CLASS if niceness >= 15 else BELOW_NORMAL_PRIORITY_CLASS
+        kernel32 = ctypes.windll.kernel32
+        if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), priority):
+            logger.warning("文字起こしワーカーの優先度を下げられませんでした")
+
+def _init_transcriber(model_name, threads, niceness):
+    """文字起こしのワーカープロセスの初期化（優先度を下げてモデルを読み込む）"""
+    global _whisper_model
+    lower_priority(niceness)
+    from faster_whisper import WhisperModel
+    _whisper_model = WhisperModel(model_name, device="cpu", compute_type="int8", cpu_threads=threads)
+
+def restore_time(position, removed):
+    """無音を詰めたトラック上の位置（秒）を、詰める前の位置に戻す"""
+    for start, end in sorted(removed):
+        if start > position:
+            break
+        position += end - start
+    return position
+
+def transcribe_batch(items, language):
+    """セグメントをまとめて文字起こしし、各セグメントの隣に .transcript.txt を書き出す
+
+    ワーカープロセスで実行する。(書き出し先, 発言数, エラー) の一覧を返す。
+    """
+    results = []
+    for item in items:
+        try:
+            lines = []
+            for track in item["tracks"]:
+                segments, _ = _whisper_model.transcribe(track["path"], language=language, beam_size=1, vad_filter=True)
+                for segment in segments:
+                    text = segment.text.strip()
+                    if text:
+                        start = track["offset"] + restore_time(segment.start, track["removed"])
+                        end = track["offset"] + restore_time(segment.end, track["removed"])
+                        lines.append((start, end, track["speaker"], text))
+            lines.sort(key=lambda line: line[0])
+            with open(item["output"], 'w', encoding='utf-8') as f:
+                for start, end, speaker, text in lines:
+                    f.write(f"[{format_timestamp(start)} - {format_timestamp(end)}] {speaker}: {text}\n")
+            results.append((item["output"], len(lines), None))
+        except Exception as e:
+            results.append((item["output"], 0, str(e)))
+    return results
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes):02d}:{seconds:05.2f}"
+
+class TranscriptionQueue:
+    """保存したセグメントを低優先度のプロセスプールでまとめて文字起こしするキュー
+
+    エンコードキューから保存に成功したセグメントを受け取り、サーバーをまたいで
+    TRANSCRIBE_BATCH_SIZE 件（または TRANSCRIBE_BATCH_WAIT 秒分）ずつワーカーへ渡す。
+    登録は待たずに行い、キューが満杯なら諦めるので録音の遅延には影響しない。
+    実行中のバッチはワーカー数までに抑える。
+    """
+
+    def __init__(self, maxsize, workers, batch_size, batch_wait):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = None
+        self.pool = None
+        self.slots = None
+        self.collector = None
+        self.running = 0  # 実行中のバッチ数
+        self.disabled = False
+
+    def start(self):
+        """プロセスプールと集約タスクを起動する（二重起動しない）"""
+        if self.collector is not None or self.disabled:
+            return
+        if importlib.util.find_spec("faster_whisper") is None:
+            logger.warning("faster-whisper がインストールされていないため、文字起こしは行いません")
+            self.disabled = True
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_transcriber, initargs=(TRANSCRIBE_MODEL, TRANSCRIBE_THREADS, TRANSCRIBE_NICE))
+        self.collector = asyncio.create_task(self._collect())
+        logger.info(f"文字起こしワーカーを{self.workers}個起動しました（モデル: {TRANSCRIBE_MODEL}）")
+
+    def submit(self, stream, filename):
+        """保存したセグメントを登録する（待たない）"""
+        self.start()
+        if self.disabled:
+            return
+        item = self._item(stream, filename)
+        if not item["tracks"]:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning(f"文字起こしキューが満杯のため、スキップします: {filename}")
+            metrics.inc("recorder_transcriptions_total", guild=metric_guild(stream.guild), result="skipped")
+
+    def _item(self, stream, filename):
+        """ワーカーへ渡す内容（トラックごとのファイル・話者名・開始位置・詰めた無音）"""
+        display_names = resolve_display_names(stream.guild, stream.user_bytes)
+        tracks = []
+        if stream.multitrack:
+            for user, (mixer, gate, encoder) in stream.outputs.items():
+                if encoder.failed or not os.path.exists(encoder.filename):
+                    continue
+                tracks.append({
+                    "path": encoder.filename,
+                    "speaker": display_names.get(user) or str(user),
+                    "offset": mixer.first_frame / SAMPLE_RATE if mixer.first_frame is not None else 0.0,
+                    "removed": [tuple(interval) for interval in gate.removed]
+                })
+            for user, (writer, first_frame) in stream.opus_tracks.items():
+                if writer.failed or not os.path.exists(writer.filename):
+                    continue
+                tracks.append({
+                    "path": writer.filename,
+                    "speaker": display_names.get(user) or str(user),
+                    "offset": first_frame / SAMPLE_RATE,
+                    "removed": []
+                })
+        elif stream.saved_path and os.path.exists(stream.saved_path):
+            # ミックスは話者を区別できない
+            gate = stream.outputs[None][1] if None in stream.outputs else None
+            tracks.append({
+                "path": stream.saved_path,
+                "speaker": "ミックス",
+                "offset": 0.0,
+                "removed": [tuple(interval) for interval in gate.removed] if gate is not None else []
+            })
+        return {
+            "output": os.path.splitext(filename)[0] + ".transcript.txt",
+            "guild": metric_guild(stream.guild),
+            "tracks": tracks
+        }
+
+    async def _collect(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0, deadline - time.monotonic())))
+                except asyncio.TimeoutError:
+                    break
+            await self.slots.acquire()
+            asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch):
+        self.running += 1
+        started = time.monotonic()
+        guilds = {item["output"]: item["guild"] for item in batch}
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.pool, transcribe_batch, [{"output": item["output"], "tracks": item["tracks"]} for item in batch],
+                TRANSCRIBE_LANGUAGE)
+        except Exception as e:
+            logger.error(f"文字起こしのワーカーでエラーが発生しました: {e}")
+            results = [(item["output"], 0, str(e)) for item in batch]
+        finally:
+            self.running -= 1
+            self.slots.release()
+        for output, count, error in results:
+            if error is None:
+                logger.info(f"文字起こしを保存しました: {output}（{count}件の発言）")
+            else:
+                logger.error(f"文字起こしに失敗しました: {output}: {error}")
+            metrics.inc("recorder_transcriptions_total", guild=guilds[output], result="failure" if error else "success")
+        logger.info(f"{len(batch)}件のセグメントを文字起こししました（{time.monotonic() - started:.1f}秒）")
+
+    def describe(self):
+        """状態表示用の文字列"""
+        if self.disabled or self.queue is None:
+            return "文字起こし: 停止中"
+        return f"文字起こし: 実行中 {self.running}/{self.workers}, 待機 {self.queue.qsize()}/{self.maxsize}"
+
+transcription_queue = TranscriptionQueue(TRANSCRIBE_QUEUE_SIZE, TRANSCRIBE_WORKERS, TRANSCRIBE_BATCH_SIZE,
+                                         TRANSCRIBE_BATCH_WAIT)
+
+@bot.event
+async def on_ready():
+    logger.info(f'{bot.user} としてログインしました')
+    logger.info(f'インテント設定: {bot.intents}')
+    if not getattr(bot, 'boot_reported', False):
+        bot.boot_reported = True
+        rss = current_rss_mb()
+        logger.info(f"起動完了: {time.perf_counter() - BOOT_STARTED:.1f}秒, "
+                    f"メモリ {f'{rss:.0f}MB' if rss is not None else '不明'}, サーバー {len(bot.guilds)}, "
+                    f"キャッシュ中のメンバー {sum(len(guild.members) for guild in bot.guilds)}")
+        asyncio.create_task(probe_ffmpeg())
+    encode_queue.start()
+    if SPOOL_ENABLED and not getattr(bot, 'spools_recovered', False):
+        bot.spools_recovered = True
+        asyncio.create_task(recover_spools())
+    if not monitor_event_loop.is_running():
+        monitor_event_loop.start()
+    if LIVE_PORT is not None and not getattr(bot, 'live_started', False):
+        bot.live_started = True
+        try:
+            await start_live_server()
+        except Exception as e:
+            logger.error(f"配信サーバーの起動に失敗しました: {e}")
+    if METRICS_PORT is not None and not getattr(bot, 'metrics_started', False):
+        bot.metrics_started = True
+        try:
+            await start_metrics_server()
+        except Exception as e:
+            logger.error(f"メトリクスの公開に失敗しました: {e}")
+    if SHARD_ID is not None:
+        connect_control_channel()
+    logger.info('監視ループを開始しました')
+    print('------')
+
+@bot.event
+async def on_error(event, *args, **kwargs):
+    """エラーハンドリング"""
+    if event == 'on_message':
+        error_logger.error(f'Unhandled message: {args[0]}', exc_info=True)
+    else:
+        error_logger.error(f'Unhandled event: {event}', exc_info=True)
+    logger.error(f'An error occurred in {event}')
+
+@bot.event
+async def on_command_error(ctx, error):
+    """コマンドエラーのハンドリング"""
+    if isinstance(error, commands.CommandInvokeError):
+        logger.error(f'コマンド実行エラー: {error.original}')
+        await ctx.send(f"エラーが発生しました: {error.original}")
+    else:
+        logger.error(f'コマンドエラー: {error}')
+        await ctx.send(f"コマンドエラー: {error}")
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    """音声状態の変更を監視して、録音中のチャンネルが無人になったら録音を停止する"""
+    if after.channel is not None:
+        remember_display_name(member)
+    if before.channel is None or before.channel == after.channel:
+        return
+    
+    if member.id == bot.user.id:
+        # ボット自身が別のチャンネルへ移された場合は索引を付け替える
+        session = recording_sessions.get(member.guild.id)
+        if session is not None and after.channel is not None:
+            recording_sessions.move(session, after.channel.id)
+        return
+    
+    # ユーザーがチャンネルから抜けた場合（録音していないチャンネルならここで終わる）
+    session = recording_sessions.for_channel(before.channel.id)
+    if session is None or not session.active:
+        return
+    if len(before.channel.voice_states) <= 1:  # ボットだけが残った場合
+        logger.info(f"全員が退出したため、{before.channel.name}での録音を停止します")
+        await stop_session(session.guild_id)
+
+@bot.command(name='record')
+async def record(ctx, mode: str = None):
+    """音声チャンネルの録音を開始します（`!record multitrack` でユーザーごとに別ファイル）"""
+    try:
+        if mode not in (None, 'multitrack'):
+            await ctx.send("使い方: `!record` または `!record multitrack`")
+            return
+        multitrack = mode == 'multitrack'
+        
+        # ユーザーが音声チャンネルに接続しているか確認
+        if ctx.author.voice is None:
+            await ctx.send("音声チャンネルに接続してから実行してください。")
+            return
+            
+        voice_channel = ctx.author.voice.channel
+        
+        # 既に録音中かチェック
+        if ctx.guild.id in recording_sessions:
+            await ctx.send("既に録音中です。`!stop`で録音を停止できます。")
+            return
+        
+        # 録音用ディレクトリの作成
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        session_dir = os.path.join(RECORDINGS_DIR, f"{ctx.guild.id}_{timestamp}")
+        os.makedirs(session_dir, exist_ok=True)
+        
+        # 音声チャンネルに接続
+        voice_client = await voice_channel.connect(cls=RecorderVoiceClient)
+        
+        # 録音セッション情報を保存
+        session = RecordingSession(ctx, voice_client, session_dir, multitrack=multitrack)
+        recording_sessions.add(session)
+        # 目録に書けなくても録音は続ける（セッションは最初のセグメントを記録するときに登録される）
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, catalog.start_session, ctx.guild.id, ctx.guild.name,
+                voice_channel.id, voice_channel.name, session_dir, multitrack)
+        except Exception as e:
+            logger.error(f"目録への記録に失敗しました: {e}")
+        
+        # 録音ループを開始
+        asyncio.create_task(recording_loop(session))
+        
+        # 保存先情報も含めたメッセージを表示
+        await ctx.send(f"{voice_channel.name} での録音を開始しました。\n"
+                       f"10分ごとにファイルを分割して保存します。\n"
+                       + ("ユーザーごとのトラックとマニフェスト(JSON)を保存します。\n" if multitrack else "")
+                       + f"保存先: {session_dir}")
+        
+        logger.info(f"{ctx.guild.name}の{voice_channel.name}で録音を開始しました")
+        logger.info(f"チャンネルユーザー数: {len(voice_channel.voice_states)}")
+    
+    except Exception as e:
+        logger.error(f"録音開始中にエラーが発生しました: {e}")
+        await ctx.send(f"録音開始中にエラーが発生しました: {e}")
+
+async def recording_loop(session):
+    """10分ごとに録音を区切るループ処理
+
+    区切りの時刻の前後 SEGMENT_SILENCE_WINDOW の間は、全員が黙った時点で区切り、
+    発言の途中で切れないようにする（時刻に近い無音ほど短くても区切る。見つからなければ範囲の終わりで区切る）。
+    セグメントが SEGMENT_MAX_BYTES に達した場合は、シンクからの通知で時刻を待たずに区切る。
+    区切りではシンクの書き込み先を切り替えるだけで録音は止めないため、
+    変換中に届いた音声も次のセグメントに残る。
+    接続の切断は supervise_connection がイベントを受けて復旧するので、ここでは監視しない。
+    """
+    ctx = session.ctx
+    try:
+        # ミックスの配信（マルチトラックにはミックスが無いので配信しない）
+        live = None
+        if LIVE_PORT is not None and not session.multitrack:
+            live = live_taps[session.guild_id] = LiveTap(session.guild_id, asyncio.get_running_loop())
+        
+        # サイズの上限に達したら、書き込みスレッドから録音ループを起こす
+        on_budget = None
+        if SEGMENT_MAX_BYTES:
+            loop = asyncio.get_running_loop()
+            on_budget = lambda: loop.call_soon_threadsafe(session.cut_requested.set)
+        
+        # 録音シンクの準備（受信したPCMをそのままffmpegへ流す）
+        sink = StreamingSink(
+            f"{session.session_dir}/segment_{session.segment}{OUTPUT_EXT}",
+            multitrack=session.multitrack,
+            guild=ctx.guild,
+            live=live,
+            on_budget=on_budget
+        )
+        session.sink = sink
+        deadline = time.monotonic() + RECORDING_LENGTH
+        
+        try:
+            resume_recording(session)
+            voice_client = session.voice_client
+            logger.info(f"音声接続状態: 接続={voice_client.is_connected()}, 再生中={voice_client.is_playing()}")
+            logger.info(f"音声チャンネルのユーザー数: {len(voice_client.channel.voice_states)}")
+            logger.info(f"{ctx.guild.name}: セグメント{session.segment}の録音を開始しました")
+        except Exception as e:
+            asyncio.create_task(supervise_connection(session, f"録音を開始できませんでした: {e}"))
+        
+        while session.active:
+            # 区切るまで待機（停止された・サイズの上限に達したときはすぐに起きる）
+            session.cut_requested.clear()
+            reason, timeout = segment_cut_reason(sink.stream, deadline)
+            if reason is None:
+                await session.wait(timeout, cut=True)
+                continue
+            
+            try:
+                # 書き込み先を次のセグメントに切り替え、終わったセグメントの変換はエンコードキューに任せる
+                if not session.transition(RecordingSession.ROTATING):
+                    break
+                segment = session.segment
+                filename = sink.stream.filename
+                session.segment += 1
+                stream = sink.rotate(f"{session.session_dir}/segment_{session.segment}{OUTPUT_EXT}")
+                deadline = time.monotonic() + RECORDING_LENGTH
+                session.transition(RecordingSession.RECORDING)
+                logger.info(f"{ctx.guild.name}: セグメント{session.segment}に切り替えました（{reason}）")
+                await encode_queue.submit(
+                    stream, filename, f"{ctx.guild.name} セグメント{segment}",
+                    on_done=boundary_loss_recorder(session, stream, sink.stream,
+                                                   segment_saved_notifier(ctx, segment, stream))
+                )
+            
+            except Exception as e:
+                logger.error(f"録音ループ中にエラーが発生しました: {e}")
+                notifications.notify(ctx.channel, f"セグメントの切り替え中にエラーが発生しました: {e}", "error")
+    
+    except Exception as e:
+        logger.error(f"録音ループ全体でエラーが発生しました: {e}")
+        notifications.notify(ctx.channel, f"録音が中断されました: {e}", "error")
+
+def boundary_loss_recorder(session, stream, next_stream, on_done):
+    """セグメントの変換が終わったら、区切りで失われた・ずれた音声の長さを記録してから on_done を呼ぶ
+
+    終わったセグメントで区切りの MIX_LATENCY 以内に捨てたフレームは finish() の後でないと確定しないので、
+    変換の完了時に数える。次のセグメントで開始より前の音声として先頭に寄せたフレームは別に数える。
+    区切りと関係ない位置で捨てたフレームは recorder_dropped_frames_total で数える。
+    """
+
+    async def record(success):
+        dropped_ms = stream.boundary_dropped_frames / SAMPLE_RATE * 1000
+        shifted_ms = next_stream.clamped_frames / SAMPLE_RATE * 1000
+        session.boundary_loss_ms.append((dropped_ms, shifted_ms))
+        logger.info(f"{session.ctx.guild.name}: 区切りで捨てた音声: {dropped_ms:.1f}ms, 先頭に寄せた音声: {shifted_ms:.1f}ms")
+        await on_done(success)
+
+    return record
+
+def segment_cut_reason(stream, deadline):
+    """今セグメントを区切るべきなら (理由, None) を、まだなら (None, 次に確かめるまでの秒数) を返す"""
+    if stream.budget_reached:
+        return "サイズの上限", None
+    half = min(SEGMENT_SILENCE_WINDOW, RECORDING_LENGTH) / 2
+    now = time.monotonic()
+    if now < deadline - half:
+        return None, deadline - half - now
+    if now >= deadline + half:
+        return "時間", None  # 範囲内に無音が無かった
+    required, slope = required_silence(now - deadline, half)
+    silent = stream.silent_for()
+    if silent >= required:
+        return f"無音 {silent:.1f}秒", None
+    # 誰も話し出さなければ無音の条件を満たす時刻まで待つ（求める長さも縮んでいく分を見込む）
+    wait = (required - silent) / (1 + slope)
+    if now < deadline:
+        wait = min(wait, deadline - now)
+    return None, min(max(wait, 0.01), deadline + half - now)
+
+def required_silence(offset, half):
+    """区切りの時刻から offset 秒の時点で区切ってよい無音の長さと、その1秒あたりの変化量
+
+    区切りの時刻より前は離れているほど長い無音（範囲の始まりで SEGMENT_SILENCE_GAP の4倍）を求め、
+    時刻を過ぎたら短い無音（範囲の終わりで半分）でも区切る。
+    こうすると、時刻に近い無音で区切られやすくなる。
+    """
+    position = offset / half  # -1（範囲の始まり）〜 1（範囲の終わり）
+    if position < 0:
+        return SEGMENT_SILENCE_GAP * (1 - 3 * position), 3 * SEGMENT_SILENCE_GAP / half
+    return SEGMENT_SILENCE_GAP * (1 - 0.5 * position), 0.5 * SEGMENT_SILENCE_GAP / half
+
+def resume_recording(session):
+    """現在のVoiceClientで、セッションのシンクへの録音を開始・再開する
+
+    再接続後も同じシンクを渡すので、録音中のセグメントとスプールはそのまま続く。
+    """
+    if not session.voice_client.recording:
+        session.voice_client.start_recording(session.sink, finished_callback, session.ctx)
+
+async def supervise_connection(session, reason):
+    """接続が切れた・受信が止まったセッションを復旧する
+
+    最初はすぐに復旧を試み、失敗したらジッター付きの指数バックオフで
+    RECONNECT_ATTEMPTS 回まで再試行する。それでも駄目なら録音を停止する。
+    """
+    if session.reconnecting or not session.active:
+        return
+    session.reconnecting = True
+    ctx = session.ctx
+    guild = str(session.guild_id)
+    logger.warning(f"{ctx.guild.name}: 録音が中断されました（{reason}）。復旧を試みます")
+    try:
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if attempt:
+                # 同時に切れた複数のサーバーが一斉に再接続しないよう、待ち時間をばらつかせる
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** (attempt - 1))
+                await session.wait(delay * random.uniform(0.5, 1.5))
+            if not session.active:
+                return
+            try:
+                await restore_voice_client(session)
+                if not session.active:
+                    return
+                resume_recording(session)
+            except Exception as e:
+                metrics.inc("recorder_reconnects_total", guild=guild, result="failure")
+                logger.error(f"{ctx.guild.name}: 復旧に失敗しました（{attempt + 1}/{RECONNECT_ATTEMPTS}回目）: {e}")
+                continue
+            metrics.inc("recorder_reconnects_total", guild=guild, result="success")
+            logger.info(f"{session.voice_client.channel.name}で録音を再開しました（{attempt + 1}回目）")
+            return
+        
+        logger.error(f"{ctx.guild.name}: 復旧できなかったため録音を停止します")
+        notifications.notify(ctx.channel, "音声チャンネルに再接続できなかったため、録音を停止しました。", "error")
+        await stop_session(session.guild_id)
+    finally:
+        session.reconnecting = False
+
+async def restore_voice_client(session):
+    """切断されたVoiceClientを接続し直す（py-cordが再接続中ならそれを待つ）"""
+    voice_client = session.voice_client
+    if voice_client.is_connected():
+        return
+    guild = session.ctx.guild
+    if guild.voice_client is voice_client:
+        # py-cordが自分で再接続している途中なら、それが終わるのを待つ
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, voice_client._connected.wait, RECONNECT_WAIT):
+            return
+        await voice_client.disconnect(force=True)
+    channel = guild.get_channel(session.channel_id) or voice_client.channel
+    session.voice_client = await channel.connect(cls=RecorderVoiceClient)
+    if not session.active:
+        # 接続を待っている間に停止された（stop_session は古い接続しか切断していない）
+        await session.voice_client.disconnect(force=True)
+        return
+    if channel.id != session.channel_id:
+        recording_sessions.move(session, channel.id)
+
+class NotificationQueue:
+    """チャンネルへの通知をまとめて埋め込みで送るキュー
+
+    notify() は待たずに戻る。送信はチャンネルごとのタスクが NOTIFY_INTERVAL ごとに、
+    溜まった通知を1つの埋め込みにまとめて行う。py-cordがレート制限で送信を待たせている間に
+    届いた通知は次の埋め込みにまとめられるので、送信数は増えず、録音やエンコードも待たされない。
+    """
+
+    COLORS = {"info": discord.Color.green(), "warning": discord.Color.orange(), "error": discord.Color.red()}
+    LEVELS = ["info", "warning", "error"]
+    DESCRIPTION_LIMIT = 4096  # 埋め込みの本文の上限（文字数）
+    SEND_ATTEMPTS = 3
+
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.outboxes = {}  # チャンネルID -> 未送信の (レベル, 本文)
+        self.tasks = {}  # チャンネルID -> 送信タスク
+
+    def notify(self, channel, text, level="info"):
+        """通知を登録する（送信は後でまとめて行う）"""
+        outbox = self.outboxes.setdefault(channel.id, collections.deque())
+        if len(outbox) >= self.max_pending:
+            _, dropped = outbox.popleft()
+            logger.warning(f"通知が溜まりすぎたため、古い通知を捨てました: {dropped}")
+        outbox.append((level, text))
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._flush(channel))
+
+    async def _flush(self, channel):
+        outbox = self.outboxes[channel.id]
+        try:
+            while outbox:
+                await asyncio.sleep(self.interval)
+                await self._send(channel, self._take(outbox))
+        finally:
+            self.tasks.pop(channel.id, None)
+            if not outbox:
+                self.outboxes.pop(channel.id, None)
+
+    def _take(self, outbox):
+        """埋め込み1つ分の通知を取り出してまとめる"""
+        lines = []
+        length = 0
+        level = "info"
+        while outbox:
+            text = outbox[0][1]
+            if len(text) > self.DESCRIPTION_LIMIT:
+                text = text[:self.DESCRIPTION_LIMIT - 1] + "…"
+            if lines and length + len(text) + 1 > self.DESCRIPTION_LIMIT:
+                break
+            item_level, _ = outbox.popleft()
+            level = max(level, item_level, key=self.LEVELS.index)
+            lines.append(text)
+            length += len(text) + 1
+        return discord.Embed(description="\n".join(lines), color=self.COLORS[level])
+
+    async def _send(self, channel, embed):
+        for attempt in range(self.SEND_ATTEMPTS):
+            try:
+                await channel.send(embed=embed)
+                return
+            except (discord.Forbidden, discord.NotFound) as e:
+                logger.error(f"通知を送信できません（{getattr(channel, 'name', channel.id)}）: {e}")
+                return
+            except discord.HTTPException as e:
+                # レート制限はpy-cordが待ってから再送するので、ここに来るのはそれ以外の失敗
+                logger.warning(f"通知の送信に失敗しました（{attempt + 1}/{self.SEND_ATTEMPTS}回目）: {e}")
+                await asyncio.sleep(2 ** attempt)
+        logger.error(f"通知を送信できなかったため破棄しました: {embed.description}")
+
+notifications = NotificationQueue(NOTIFY_INTERVAL, NOTIFY_MAX_PENDING)
+
+def segment_saved_notifier(ctx, segment, stream, final=False):
+    """エンコード完了時にチャンネルへ結果を通知するコルーチン関数を返す"""
+    label = "最終セグメント" if final else "セグメント"
+
+    async def notify(success):
+        if success and stream.partial is not None:
+            files = "\n".join(f"{path}（{seconds:.1f}秒）" for path, seconds in stream.partial)
+            notifications.notify(ctx.channel, f"{label} {segment} は変換が途中で失敗したため、2つのファイルに分かれています。\n{files}", "error")
+            logger.warning(f"{ctx.guild.name}: {label}{segment}は途中までしか変換できませんでした")
+        elif success:
+            notifications.notify(ctx.channel, f"{label} {segment} を保存しました。\n保存先: {stream.saved_path or stream.output_path}")
+            logger.info(f"{ctx.guild.name}: {label}{segment}を保存しました")
+        else:
+            notifications.notify(ctx.channel, f"{label} {segment} の保存に失敗しました。ログを確認してください。", "error")
+            logger.error(f"{ctx.guild.name}: {label}{segment}の保存に失敗")
+
+    return notify
+
+async def submit_final_segment(session):
+    """セッションの最後のセグメントをエンコードキューに渡す"""
+    session.transition(RecordingSession.ENCODING)
+    sink = session.sink
+    if sink is None:
+        session.transition(RecordingSession.STOPPED)
+        return
+    session.sink = None
+    ctx = session.ctx
+    last_segment = session.segment
+    notify = segment_saved_notifier(ctx, last_segment, sink.stream, final=True)
+    
+    async def on_done(success):
+        session.transition(RecordingSession.STOPPED)
+        await notify(success)
+    
+    await encode_queue.submit(
+        sink.stream, sink.stream.filename, f"{ctx.guild.name} 最終セグメント{last_segment}",
+        on_done=on_done
+    )
+
+async def finished_callback(sink, ctx):
+    """録音完了時のコールバック関数（受信スレッドが終わったときに呼ばれる）"""
+    logger.info(f"{ctx.guild.name}: finished_callbackが呼び出されました")
+    # 停止していないのに受信が終わった（ソケットのエラーなど）場合は復旧する
+    session = recording_sessions.get(ctx.guild.id)
+    if session is not None and session.sink is sink and session.active:
+        asyncio.create_task(supervise_connection(session, "受信が停止しました"))
+
+# ストリーミング録音の設定
+MIX_LATENCY = 1.0  # 遅れて届くパケットを待つ時間（秒）。この分だけ遅れてエンコーダへ流す
+MIX_BUFFER_SECONDS = 5  # 合成バッファの長さ（秒）
+MIX_RESYNC_FRAMES = SAMPLE_RATE // 2  # 到着時刻とこれ以上ずれたら位置を合わせ直す
+NORMALIZE_RELEASE = 0.05  # 正規化でゲインを戻す速さ（1ブロックあたり）
+VAD_FRAME = SAMPLE_RATE // 50  # 無音判定の単位（20ms）
+SPEECH_THRESHOLD = 32768 * 10 ** (SILENCE_THRESHOLD_DB / 20)  # 区切りを探すときの、話しているとみなす音量
+OPUS_SILENCE_BYTES = 3  # これ以下の長さのOpusパケットは無音フレーム
+STREAM_FLUSH_INTERVAL = 0.5  # エンコーダへ書き込む間隔（秒）
+FRAME_BYTES = CHANNELS * 2  # 1フレーム（全チャンネル分の16-bitサンプル）のバイト数
+
+class RecorderVoiceClient(discord.VoiceClient):
+    """受信パケットのRTPタイムスタンプをそのままシンクへ渡すVoiceClient
+
+    標準の recv_decoded_audio は無音をPCMに埋め込んで位置を合わせるが、
+    write_packet を持つシンクにはタイムスタンプを渡して合成側で位置を決めさせる。
+    Opusパススルーのシンクには、デコードせずにパケットを渡す。
+    再接続・切断はイベントとして supervise_connection に知らせる。
+    """
+
+    async def connect_websocket(self):
+        ws = await super().connect_websocket()
+        if self.recording:
+            # py-cordが内部で再接続した場合、受信スレッドは古い接続のままなので録音をやり直す
+            # （受信スレッドが終わると finished_callback から同じシンクで再開される）
+            self.stop_recording()
+        return ws
+
+    async def disconnect(self, *, force=False):
+        await super().disconnect(force=force)
+        # 停止した覚えの無い切断（チャンネルの削除・切断操作など）は復旧を試みる
+        session = recording_sessions.get(self.guild.id)
+        if session is not None and session.voice_client is self and session.active:
+            asyncio.create_task(supervise_connection(session, "音声チャンネルから切断されました"))
+
+    def unpack_audio(self, data):
+        # パススルーのシンクにはデコードせずにOpusパケットを渡す
+        if not getattr(self.sink, 'passthrough', False):
+            return super().unpack_audio(data)
+        if 200 <= data[1] <= 204:
+            # RTCPは音声ではないので無視する
+            return
+        if self.paused:
+            return
+        data = discord.sinks.RawData(data, self)
+        if data.decrypted_data == OPUS_SILENCE_FRAME:
+            return
+        ssrc_info = self.ws.ssrc_map.get(data.ssrc)
+        if ssrc_info is None:
+            # 誰のパケットか分かる前（SPEAKING受信前）のパケットは捨てる
+            metrics.inc("recorder_packets_dropped_total", guild=str(self.guild.id), reason="unknown_ssrc")
+            return
+        metrics.inc("recorder_packets_received_total", guild=str(self.guild.id))
+        self.sink.write_opus(ssrc_info["user_id"], data.decrypted_data, data.receive_time, data.timestamp)
+
+    def recv_decoded_audio(self, data):
+        write_packet = getattr(self.sink, 'write_packet', None)
+        if write_packet is None:
+            return super().recv_decoded_audio(data)
+        while data.ssrc not in self.ws.ssrc_map:
+            time.sleep(0.05)
+        user = self.ws.ssrc_map[data.ssrc]["user_id"]
+        metrics.inc("recorder_packets_received_total", guild=str(self.guild.id))
+        write_packet(user, data.decoded_data, data.receive_time, data.timestamp, data.decrypted_data)
+
+def ffmpeg_executable():
+    """ローカルにあればそのパスを使用、なければシステムのffmpegを使用"""
+    return FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else 'ffmpeg'
+
+ffmpeg_capabilities = None  # probe_ffmpeg() の結果
+
+async def probe_ffmpeg():
+    """ffmpegのバージョンと使えるエンコーダを調べる（結果はキャッシュする）
+
+    起動をブロックしないよう、ログイン後にイベントループ上で非同期に実行する。
+    """
+    global ffmpeg_capabilities
+    if ffmpeg_capabilities is not None:
+        return ffmpeg_capabilities
+    
+    async def run(*args):
+        process = await asyncio.create_subprocess_exec(
+            ffmpeg_executable(), '-hide_banner', *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await process.communicate()
+        return stdout.decode(errors='replace')
+    
+    try:
+        version = (await run('-version')).split('\n', 1)[0]
+        encoders = set()
+        for line in (await run('-encoders')).splitlines():
+            fields = line.split()
+            # " A....D libmp3lame  ..." の形式（先頭はフラグ、2列目がエンコーダ名）
+            if len(fields) >= 2 and len(fields[0]) == 6 and fields[0][0] == 'A':
+                encoders.add(fields[1])
+        ffmpeg_capabilities = {"available": True, "version": version, "encoders": encoders}
+    except Exception as e:
+        ffmpeg_capabilities = {"available": False, "error": str(e), "encoders": set()}
+    
+    args = OUTPUT_FORMATS[OUTPUT_FORMAT][1]
+    if args is None:
+        pass  # wavはFFmpegを使わない
+    elif not ffmpeg_capabilities["available"]:
+        logger.warning(f"FFmpegが見つかりません。{OUTPUT_FORMAT.upper()}変換ができない可能性があります: {ffmpeg_capabilities['error']}")
+        print(f"警告: FFmpegが見つかりません。{OUTPUT_FORMAT.upper()}変換には FFmpeg のインストールが必要です。")
+    elif args[1] not in ffmpeg_capabilities["encoders"]:
+        logger.warning(f"FFmpegに {args[1]} エンコーダがありません（{ffmpeg_capabilities['version']}）")
+    else:
+        logger.info(f"FFmpegが利用可能です: {ffmpeg_capabilities['version']}")
+    return ffmpeg_capabilities
+
+class PCMMixer:
+    """ユーザーごとのPCMを時刻で揃え、1本のトラックに合成する
+
+    各パケットはRTPタイムスタンプ（無い場合は直前のデータの続き）の位置に
+    int32のバッファへ足し込み、出力時に int16 へクリップまたは正規化する。
+    発言の無い区間はバッファのゼロがそのまま無音になるので、
+    出力の長さは話者数ではなく経過時間で決まる。
+
+    add() はデコードスレッドから、pop() はエンコーダへの書き込みスレッドから
+    呼ばれるため、内部状態はロックで保護する。
+    保持するのは MIX_BUFFER_SECONDS 分のバッファだけなので、
+    セグメントの長さに関係なくメモリ使用量は一定になる。
+    """
+
+    def __init__(self, mode=None, start_time=None, trim_start=False):
+        self.mode = mode or MIX_MODE
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self.trim_start = trim_start  # 最初のデータより前の無音を出力しない
+        self.first_frame = None  # 最初のデータのフレーム位置
+        self.flushed = 0  # 出力済みのフレーム位置
+        self.written_end = 0  # 受け取ったデータの最後のフレーム位置
+        self.buffer = np.zeros(MIX_BUFFER_SECONDS * SAMPLE_RATE * CHANNELS, dtype=np.int32)
+        self.anchors = {}  # user_id -> (基準フレーム位置, 基準RTPタイムスタンプ, 次の書き込み位置)
+        self.late_frames = 0  # 出力済みの位置より前に届いて捨てたフレーム数
+        self.overflow_frames = 0  # バッファより先の位置に届いて捨てたフレーム数
+        self.clamped_frames = 0  # 開始より前の音声だったため先頭に寄せたフレーム数
+        self.boundary = None  # 区切りのフレーム位置（区切られた後に設定）
+        self.boundary_dropped = 0  # 区切りの MIX_LATENCY 以内の位置で捨てたフレーム数
+        self.gain = 1.0
+        self.lock = threading.Lock()
+
+    def _position(self, user, frames, receive_time, timestamp):
+        """パケットを置くフレーム位置を決める"""
+        arrived = int((receive_time - self.start_time) * SAMPLE_RATE) - frames
+        anchor = self.anchors.get(user)
+        if anchor is not None:
+            base, base_timestamp, next_position = anchor
+            if timestamp is None:
+                expected = next_position
+            else:
+                # RTPタイムスタンプは48kHzのサンプル数で、32bitで一周する
+                expected = base + ((timestamp - base_timestamp) & 0xFFFFFFFF)
+            # 到着時刻から大きくずれた場合（再接続やクロックのずれ）は到着時刻で合わせ直す
+            if abs(expected - arrived) <= MIX_RESYNC_FRAMES:
+                self.anchors[user] = (base, base_timestamp, expected + frames)
+                return expected
+        if arrived < 0:
+            # 前のセグメントの区切りより前に話し始めた音声（先頭に寄せるので、その分だけ位置がずれる）
+            self.clamped_frames += min(-arrived, frames)
+        position = max(0, arrived)
+        self.anchors[user] = (position, timestamp if timestamp is not None else 0, position + frames)
+        return position
+
+    def mark_boundary(self, frame):
+        """区切りのフレーム位置を設定する（以降、その近くで捨てたフレームを boundary_dropped に数える）"""
+        with self.lock:
+            self.boundary = frame
+
+    def _count_boundary_drop(self, position, frames):
+        if self.boundary is not None and position >= self.boundary - int(MIX_LATENCY * SAMPLE_RATE):
+            self.boundary_dropped += frames
+
+    def add(self, user, pcm, receive_time=None, timestamp=None):
+        """ユーザーのPCMを追加する"""
+        if receive_time is None:
+            receive_time = time.perf_counter()
+        samples = np.frombuffer(pcm, dtype='<i2')
+        frames = len(samples) // CHANNELS
+        with self.lock:
+            position = self._position(user, frames, receive_time, timestamp)
+            if self.first_frame is None:
+                self.first_frame = position
+                if self.trim_start:
+                    self.flushed = max(self.flushed, position)
+            skip = max(0, self.flushed - position)
+            if skip:
+                # 既に出力済みの範囲は捨てる
+                self.late_frames += min(skip, frames)
+                self._count_boundary_drop(position, min(skip, frames))
+                if skip >= frames:
+                    return
+                samples = samples[skip * CHANNELS:]
+                position += skip
+                frames -= skip
+            offset = position - self.flushed
+            room = len(self.buffer) // CHANNELS - offset
+            if room < frames:
+                self.overflow_frames += frames - max(0, room)
+                self._count_boundary_drop(position + max(0, room), frames - max(0, room))
+                if room <= 0:
+                    return
+                samples = samples[:room * CHANNELS]
+                frames = room
+            self.buffer[offset * CHANNELS:(offset + frames) * CHANNELS] += samples
+            self.written_end = max(self.written_end, position + frames)
+
+    def end_frame(self):
+        """受け取ったデータの最後のフレーム位置"""
+        with self.lock:
+            return max(self.written_end, self.flushed)
+
+    def pop(self, until_frame):
+        """until_frame までを合成したPCMを返す（1回で返すのはバッファ1つ分まで）"""
+        with self.lock:
+            count = min(until_frame - self.flushed, len(self.buffer) // CHANNELS)
+            if count <= 0:
+                return b''
+            size = count * CHANNELS
+            mixed = self.buffer[:size].copy()
+            # バッファを前に詰める
+            self.buffer[:-size] = self.buffer[size:]
+            self.buffer[-size:] = 0
+            self.flushed += count
+            if self.mode == 'normalize':
+                mixed = self._normalize(mixed, count)
+        return np.clip(mixed, -32768, 32767).astype('<i2').tobytes()
+
+    def _normalize(self, mixed, count):
+        """ピークが16bitに収まるようにゲインを下げる（急に下げてゆっくり戻す）"""
+        peak = int(np.abs(mixed).max())
+        target = min(1.0, 32767 / peak) if peak else 1.0
+        gain = target if target < self.gain else min(target, self.gain + NORMALIZE_RELEASE)
+        # 下げるときは即座に、戻すときはブロック内で直線的に変化させて段差を避ける
+        ramp = np.linspace(min(self.gain, gain), gain, count, dtype=np.float32)
+        self.gain = gain
+        return (mixed * np.repeat(ramp, CHANNELS)).astype(np.int32)
+
+class SilenceGate:
+    """音量で無音を判定し、ミキサーとエンコーダの間で長い無音区間を詰める
+
+    音量（RMS）の計算は VAD_FRAME 単位でまとめてNumPyで行う。
+    無音が SILENCE_KEEP_SECONDS より長く続いた部分は出力せず、
+    入力側での位置（秒）を removed に記録する。
+    最初の発言より前の無音は長さだけを覚えておき、発言が始まった時点で
+    ゼロとして書き出すので、無音だけのセグメントではエンコーダが起動しない。
+    """
+
+    def __init__(self, trim=None, threshold_db=None, keep_seconds=None):
+        self.trim = SILENCE_TRIM if trim is None else trim
+        threshold_db = SILENCE_THRESHOLD_DB if threshold_db is None else threshold_db
+        keep_seconds = SILENCE_KEEP_SECONDS if keep_seconds is None else keep_seconds
+        self.threshold = 32768 * 10 ** (threshold_db / 20)
+        self.keep_frames = int(keep_seconds * SAMPLE_RATE)
+        self.position = 0  # 入力側のフレーム位置
+        self.pending = b''  # 判定単位に満たない端数
+        self.leading = 0  # 最初の発言より前の、まだ出力していない無音フレーム数
+        self.silent_run = 0  # 続いている無音のフレーム数
+        self.speech_frames = 0
+        self.removed = []  # 詰めた区間 [開始秒, 終了秒]
+
+    def _remove(self, start, frames):
+        start_sec = start / SAMPLE_RATE
+        end_sec = (start + frames) / SAMPLE_RATE
+        if self.removed and abs(self.removed[-1][1] - start_sec) < 1e-9:
+            self.removed[-1][1] = end_sec
+        else:
+            self.removed.append([start_sec, end_sec])
+
+    def _release_leading(self):
+        """最初の発言の直前に、覚えておいた無音をゼロとして書き出す"""
+        frames = self.leading
+        if self.trim and frames > self.keep_frames:
+            self._remove(self.position - frames, frames - self.keep_frames)
+            frames = self.keep_frames
+        self.leading = 0
+        return bytes(frames * FRAME_BYTES)
+
+    def process(self, pcm, final=False):
+        """PCMを受け取り、出力するPCMを返す"""
+        data = self.pending + pcm
+        unit = VAD_FRAME * FRAME_BYTES
+        usable = len(data) if final else len(data) - len(data) % unit
+        self.pending = data[usable:]
+        if not usable:
+            return b''
+        samples = np.frombuffer(data[:usable], dtype='<i2')
+        
+        # 判定単位ごとの音量をまとめて計算する（端数は最後の1単位として扱う）
+        full = len(samples) // (VAD_FRAME * CHANNELS) * VAD_FRAME * CHANNELS
+        blocks = samples[:full].reshape(-1, VAD_FRAME * CHANNELS).astype(np.float32)
+        rms = np.sqrt(np.mean(blocks * blocks, axis=1)) if len(blocks) else np.zeros(0, np.float32)
+        if full < len(samples):
+            tail = samples[full:].astype(np.float32)
+            rms = np.append(rms, np.sqrt(np.mean(tail * tail)))
+        speech = rms >= self.threshold
+        
+        out = []
+        for index, is_speech in enumerate(speech):
+            start = index * VAD_FRAME
+            frames = min(VAD_FRAME, len(samples) // CHANNELS - start)
+            chunk = data[start * FRAME_BYTES:(start + frames) * FRAME_BYTES]
+            if is_speech:
+                if self.leading:
+                    out.append(self._release_leading())
+                out.append(chunk)
+                self.speech_frames += frames
+                self.silent_run = 0
+            elif not self.speech_frames:
+                self.leading += frames
+            else:
+                keep = frames
+                if self.trim:
+                    keep = max(0, min(frames, self.keep_frames - self.silent_run))
+                    if keep < frames:
+                        self._remove(self.position + keep, frames - keep)
+                out.append(chunk[:keep * FRAME_BYTES])
+                self.silent_run += frames
+            self.position += frames
+        return b''.join(out)
+
+    def flush(self):
+        """残りの端数を処理する。無音のみで終わった場合の扱いもここで決める"""
+        out = self.process(b'', final=True)
+        if self.leading and not SKIP_SILENT_SEGMENTS:
+            out += self._release_leading()
+        return out
+
+    def summary(self):
+        return {
+            "removed": self.removed,
+            "removed_seconds": sum(end - start for start, end in self.removed),
+            "speech_seconds": self.speech_frames / SAMPLE_RATE
+        }
+
+class LoudnessLeveler:
+    """話者ごとの音量をEBU R128（ITU-R BS.1770）の方式で測り、目標のラウドネスに揃える
+
+    受け取ったPCMから 100ms ごとに直近 400ms のブロック（100msの区間4つの平均）のラウドネスを求め、
+    ゲート（-70 LUFS と、それまでの平均から -10 LU）を通ったブロックの平均を
+    積分ラウドネスとして逐次更新する。ゲインは 目標 - 積分ラウドネス で、
+    パケットの中で直線的に変化させ、ピークが上限を超える場合は下げる。
+    ffmpegの loudnorm のように2回処理する必要はなく、音声は1回流すだけで済む。
+
+    Kフィルターは100msの区間のFFTに振幅特性を掛けて適用する（パワーだけを使うので位相は不要）。
+    サンプルごとにフィルターを計算するよりずっと軽く、受信スレッドを待たせない。
+    """
+
+    STEP_FRAMES = SAMPLE_RATE * 100 // 1000
+    STEPS_PER_BLOCK = 4  # 400msのブロック
+    HISTOGRAM_MIN = -70.0  # 絶対ゲート（LUFS）
+    HISTOGRAM_STEP = 0.1
+    HISTOGRAM_BINS = 800  # -70 〜 +10 LUFS
+    MIN_BLOCKS = 10  # ゲインを決めるのに必要なブロック数（約1秒の発言）
+    PEAK_LIMIT = 32767 * 0.98
+    # BS.1770 のKフィルター（48kHz）: 高域シェルフとハイパスの2段
+    K_FILTERS = [
+        ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585]),
+        ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621]),
+    ]
+    _weights = None
+
+    def __init__(self, target=None, max_gain_db=None):
+        self.target = LOUDNESS_TARGET if target is None else target
+        self.max_gain_db = LOUDNESS_MAX_GAIN_DB if max_gain_db is None else max_gain_db
+        self.window = np.zeros((self.STEP_FRAMES, CHANNELS), dtype=np.float32)
+        self.position = 0  # 区間の書き込み位置
+        self.step_powers = collections.deque(maxlen=self.STEPS_PER_BLOCK)  # 直近の区間のパワー
+        self.counts = np.zeros(self.HISTOGRAM_BINS, dtype=np.int64)
+        self.powers = np.zeros(self.HISTOGRAM_BINS, dtype=np.float64)
+        self.gain = 1.0  # 直前のパケットの最後に掛けたゲイン
+        self.target_gain = 1.0
+
+    @classmethod
+    def weights(cls):
+        """区間のFFTの各ビンに掛ける重み（Kフィルターの振幅の2乗をパワーの平均に換算したもの）"""
+        if cls._weights is None:
+            z = np.exp(-1j * np.pi * np.arange(cls.STEP_FRAMES // 2 + 1) / (cls.STEP_FRAMES // 2))
+            response = np.ones(len(z))
+            for b, a in cls.K_FILTERS:
+                response *= np.abs(np.polyval(b[::-1], z) / np.polyval(a[::-1], z)) ** 2
+            response[1:-1] *= 2  # 片側スペクトルなので両端以外は2倍
+            cls._weights = response / cls.STEP_FRAMES ** 2 / 32768 ** 2
+        return cls._weights
+
+    def _measure(self):
+        spectrum = np.fft.rfft(self.window, axis=0)
+        self.step_powers.append(float(np.sum(self.weights() @ (spectrum.real ** 2 + spectrum.imag ** 2))))
+        if len(self.step_powers) < self.STEPS_PER_BLOCK:
+            return
+        power = sum(self.step_powers) / self.STEPS_PER_BLOCK
+        if power <= 0:
+            return
+        loudness = -0.691 + 10 * np.log10(power)
+        index = int((loudness - self.HISTOGRAM_MIN) / self.HISTOGRAM_STEP)
+        if index < 0:
+            return  # 絶対ゲート以下（無音）
+        index = min(index, self.HISTOGRAM_BINS - 1)
+        self.counts[index] += 1
+        self.powers[index] += power
+        integrated = self.integrated()
+        if integrated is not None:
+            gain_db = min(self.max_gain_db, max(-self.max_gain_db, self.target - integrated))
+            self.target_gain = 10 ** (gain_db / 20)
+
+    def integrated(self):
+        """これまでの積分ラウドネス（LUFS）。ブロックが足りなければNone"""
+        total = self.counts.sum()
+        if total < self.MIN_BLOCKS:
+            return None
+        relative = -0.691 + 10 * np.log10(self.powers.sum() / total) - 10
+        start = max(0, int(np.ceil((relative - self.HISTOGRAM_MIN) / self.HISTOGRAM_STEP)))
+        count = self.counts[start:].sum()
+        if not count:
+            return None
+        return -0.691 + 10 * np.log10(self.powers[start:].sum() / count)
+
+    def process(self, pcm):
+        """PCMを受け取り、ゲインを掛けたPCMを返す"""
+        samples = np.frombuffer(pcm, dtype='<i2').reshape(-1, CHANNELS).astype(np.float32)
+        frames = len(samples)
+        if not frames:
+            return pcm
+        # 100msの区間が埋まるごとに測る
+        offset = 0
+        while offset < frames:
+            count = min(frames - offset, self.STEP_FRAMES - self.position)
+            self.window[self.position:self.position + count] = samples[offset:offset + count]
+            self.position += count
+            offset += count
+            if self.position == self.STEP_FRAMES:
+                self.position = 0
+                self._measure()
+        
+        # ゲインを直前の値から滑らかに変え、ピークが上限を超えないようにする
+        target = self.target_gain
+        peak = float(np.abs(samples).max())
+        if peak * target > self.PEAK_LIMIT:
+            target = self.PEAK_LIMIT / peak
+        if target == 1.0 and self.gain == 1.0:
+            return pcm
+        ramp = np.linspace(self.gain, target, frames, dtype=np.float32)[:, None]
+        self.gain = target
+        return np.clip(samples * ramp, -32768, 32767).astype('<i2').tobytes()
+
+class PCMEncoder:
+    """常駐するffmpegの標準入力へPCMを書き込むエンコーダ
+
+    ffmpegは最初のデータが届いた時点で起動する。
+    OUTPUT_FORMAT が wav の場合はffmpegを使わずに直接書き出す。
+    close() で標準入力を閉じて終了を待つ（ブロックするのでスレッドから呼ぶこと）。
+    """
+
+    def __init__(self, filename, output_format=None):
+        self.filename = filename
+        self.output_format = output_format or OUTPUT_FORMAT
+        self.process = None
+        self.wav_file = None
+        self.stderr_file = None
+        self.failed = False
+        self.fallback_filename = None  # ffmpegが使えなくなった後の書き出し先
+        self.fallback_offset = None  # 書き出し先を切り替えるまでにffmpegへ渡したバイト数（0なら全体がWAVにある）
+        self.bytes_written = 0
+        self.started_at = None
+
+    def _open_fallback(self):
+        """ffmpegが起動できない・途中で落ちた場合は、以降のPCMを隣のWAVへ書き出す"""
+        self.fallback_offset = self.bytes_written
+        self.fallback_filename = os.path.splitext(self.filename)[0] + '.wav'
+        if self.fallback_filename == self.filename:
+            self.fallback_filename = os.path.splitext(self.filename)[0] + '_fallback.wav'
+        self.wav_file = wave.open(self.fallback_filename, 'wb')
+        self.wav_file.setnchannels(CHANNELS)
+        self.wav_file.setsampwidth(2)  # 16-bit PCM
+        self.wav_file.setframerate(SAMPLE_RATE)
+        logger.warning(f"FFmpegが使えないため、WAVファイルに保存します: {self.fallback_filename}")
+
+    def _open(self):
+        codec_args = OUTPUT_FORMATS[self.output_format][1]
+        if codec_args is None:
+            self.wav_file = wave.open(self.filename, 'wb')
+            self.wav_file.setnchannels(CHANNELS)
+            self.wav_file.setsampwidth(2)  # 16-bit PCM
+            self.wav_file.setframerate(SAMPLE_RATE)
+            return
+        ffmpeg_cmd = [
+            ffmpeg_executable(),
+            '-hide_banner', '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS),
+            '-i', 'pipe:0',
+            *codec_args,
+            '-y',  # 既存ファイルを上書き
+            self.filename
+        ]
+        logger.info(f"実行するFFmpegコマンド: {' '.join(ffmpeg_cmd)}")
+        # エラー出力はパイプが詰まらないよう一時ファイルで受ける
+        self.stderr_file = tempfile.TemporaryFile()
+        self.started_at = time.monotonic()
+        try:
+            self.process = subprocess.Popen(
+                ffmpeg_cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self.stderr_file
+            )
+        except Exception as e:
+            logger.error(f"FFmpegの起動に失敗しました: {e}")
+            self.failed = True
+            self._open_fallback()
+
+    def write(self, pcm):
+        if not pcm:
+            return
+        if self.process is None and self.wav_file is None and not self.failed:
+            self._open()
+        if not self.failed and self.process is not None:
+            try:
+                self.process.stdin.write(pcm)
+            except (BrokenPipeError, OSError) as e:
+                logger.error(f"FFmpegへの書き込みに失敗しました: {e}")
+                self.failed = True
+                self._open_fallback()
+        if self.wav_file is not None:
+            self.wav_file.writeframes(pcm)
+        self.bytes_written += len(pcm)
+
+    def close(self):
+        """エンコードを終了させ、変換に成功したかを返す"""
+        if self.wav_file is not None:
+            self.wav_file.close()
+        if self.process is None:
+            return self.wav_file is not None and not self.failed
+        peak_rss = process_peak_rss(self.process.pid)
+        if peak_rss is not None:
+            metrics.observe("recorder_ffmpeg_peak_rss_bytes", peak_rss, format=self.output_format)
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        returncode, cpu_seconds = wait_with_usage(self.process)
+        metrics.observe("recorder_ffmpeg_wall_seconds", time.monotonic() - self.started_at, format=self.output_format)
+        if cpu_seconds is not None:
+            metrics.observe("recorder_ffmpeg_cpu_seconds", cpu_seconds, format=self.output_format)
+        success = returncode == 0 and not self.failed
+        if success:
+            logger.info(f"FFmpeg変換成功: {self.filename}")
+        else:
+            self.stderr_file.seek(0)
+            error_output = self.stderr_file.read().decode(errors='replace') or "不明なエラー"
+            logger.error(f"FFmpeg変換エラー: {error_output}")
+            self.failed = True
+        self.stderr_file.close()
+        return success
+
+def wait_with_usage(process):
+    """プロセスの終了を待ち、(終了コード, 消費したCPU時間の秒数) を返す
+
+    CPU時間は os.wait4 が使える環境（Linux/macOS）でだけ取得でき、それ以外ではNone。
+    """
+    if hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            pass
+        else:
+            process.returncode = exit_code(status)
+            return process.returncode, usage.ru_utime + usage.ru_stime
+    return process.wait(), None
+
+def process_peak_rss(pid):
+    """実行中のプロセスの最大使用メモリ（バイト）。/proc が無い環境ではNone
+
+    os.wait4 や RUSAGE_CHILDREN の ru_maxrss は、exec する前の（Pythonから複製した）
+    メモリも含んでしまうので、ffmpeg自身の値は終了前に /proc から読む。
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def exit_code(status):
+    """os.wait4 の終了ステータスを終了コードに変換する（シグナルで終了した場合は負の値）"""
+    if hasattr(os, 'waitstatus_to_exitcode'):  # Python 3.9以降
+        return os.waitstatus_to_exitcode(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def opus_packet_samples(packet):
+    """OpusパケットのTOCバイトから、含まれるサンプル数（48kHz）を求める"""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:  # SILK: 10/20/40/60ms
+        frame = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:  # Hybrid: 10/20ms
+        frame = (480, 960)[config & 1]
+    else:  # CELT: 2.5/5/10/20ms
+        frame = (120, 240, 480, 960)[config & 3]
+    code = toc & 3
+    if code == 0:
+        count = 1
+    elif code in (1, 2):
+        count = 2
+    else:
+        count = packet[1] & 0x3F if len(packet) > 1 else 1
+    return frame * count
+
+def _ogg_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+OGG_CRC_TABLE = _ogg_crc_table()
+OPUS_SILENCE_FRAME = b"\xf8\xff\xfe"  # Discordが送ってくる20msの無音フレーム
+OPUS_PRE_SKIP = 312
+
+def ogg_page(serial, sequence, granule, packets, flags=0):
+    """パケットの一覧から1つのOggページを組み立てる"""
+    lacing = bytearray()
+    for packet in packets:
+        lacing.extend(b'\xff' * (len(packet) // 255))
+        lacing.append(len(packet) % 255)
+    header = bytearray(b'OggS' + bytes([0, flags]) + granule.to_bytes(8, 'little')
+                       + serial.to_bytes(4, 'little') + sequence.to_bytes(4, 'little')
+                       + b'\x00\x00\x00\x00' + bytes([len(lacing)]) + lacing)
+    page = header + b''.join(packets)
+    crc = 0
+    for byte in page:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    page[22:26] = crc.to_bytes(4, 'little')
+    return page
+
+def opus_header_packets():
+    """Ogg Opusの先頭に置く OpusHead と OpusTags"""
+    head = (b'OpusHead' + bytes([1, CHANNELS]) + OPUS_PRE_SKIP.to_bytes(2, 'little')
+            + SAMPLE_RATE.to_bytes(4, 'little') + (0).to_bytes(2, 'little') + bytes([0]))
+    vendor = b'discord-recorder'
+    tags = b'OpusTags' + len(vendor).to_bytes(4, 'little') + vendor + (0).to_bytes(4, 'little')
+    return head, tags
+
+class OggOpusWriter:
+    """受信したOpusパケットをデコードせずにOgg(.ogg)コンテナへ書き出す
+
+    RTPタイムスタンプの抜け（発言していない区間）は無音フレームで埋めて、
+    再生時の時間が実際の経過時間と一致するようにする。
+    タイムスタンプが到着時刻と大きく食い違う場合（再接続やSSRC・クロックの変化）は
+    PCMMixer と同じく到着時刻で合わせ直すので、不連続があっても無音が挿入されすぎない。
+    パケットは受信スレッドから書き込まれるため、ページは約1秒ごとにまとめて書く。
+    """
+
+    PRE_SKIP = OPUS_PRE_SKIP
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.serial = int.from_bytes(os.urandom(4), 'little')
+        self.sequence = 0
+        self.granule = self.PRE_SKIP
+        self.next_timestamp = None
+        self.start_time = None  # トラックの先頭に当たる到着時刻（perf_counter基準）
+        self.packets = []
+        self.bytes_written = 0
+        self.failed = False
+        head, tags = opus_header_packets()
+        self._write_page([head], 0, 0x02)
+        self._write_page([tags], 0, 0)
+
+    def _write_page(self, packets, granule, flags):
+        self.file.write(ogg_page(self.serial, self.sequence, granule, packets, flags))
+        self.sequence += 1
+
+    def _flush(self, flags=0):
+        if self.packets or flags:
+            self._write_page(self.packets, self.granule, flags)
+            self.packets = []
+
+    def write(self, packet, timestamp, receive_time):
+        samples = opus_packet_samples(packet)
+        if self.next_timestamp is None:
+            self.start_time = receive_time - samples / SAMPLE_RATE
+        else:
+            # RTPタイムスタンプの抜けを無音フレームで埋める（32bitで一周する。巻き戻った場合は埋めない）
+            gap = (timestamp - self.next_timestamp) & 0xFFFFFFFF
+            if gap >= 0x80000000:
+                gap = 0
+            # 到着時刻から見た抜けと大きくずれた場合は到着時刻に合わせる
+            arrived = int((receive_time - self.start_time) * SAMPLE_RATE) - samples
+            elapsed = max(0, arrived - (self.granule - self.PRE_SKIP))
+            if abs(gap - elapsed) > MIX_RESYNC_FRAMES:
+                gap = elapsed
+            for _ in range(gap // 960):
+                self._append(OPUS_SILENCE_FRAME, 960)
+        self._append(bytes(packet), samples)
+        self.next_timestamp = (timestamp + samples) & 0xFFFFFFFF
+        self.bytes_written += len(packet)
+
+    def _append(self, packet, samples):
+        # 1ページの lacing は255個まで（1パケットは255バイト未満を想定）
+        if len(self.packets) >= 50 or sum(len(p) // 255 + 1 for p in self.packets) + len(packet) // 255 + 1 > 255:
+            self._flush()
+        self.packets.append(packet)
+        self.granule += samples
+
+    def sync(self):
+        """書きかけのページも含めてディスクへ書き込む"""
+        self._flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self._flush(0x04)  # EOS
+        self.file.close()
+        return True
+
+class LiveTap:
+    """録音中のミックスをOgg/Opusで配信するためのリングバッファ（サーバーごとに1つ）
+
+    SegmentStream がエンコーダへ書き込むミックスを受け取り、聴いている人がいる間だけ
+    Opusにエンコードしてページ単位でリングバッファに積む。
+    バッファは LIVE_BUFFER_SECONDS 分で古いページから捨てるので、遅い聴取者がいても
+    メモリは増えず、書き込み側が待たされることもない（追いつけない聴取者はページを飛ばす）。
+    セグメントが切り替わっても同じタップを使うので、配信は途切れない。
+    """
+
+    FRAME_SAMPLES = SAMPLE_RATE // 50  # 20ms
+    PAGE_PACKETS = 10  # 1ページあたりのパケット数（200ms）
+
+    def __init__(self, guild_id, loop):
+        self.guild_id = guild_id
+        self.loop = loop
+        self.serial = int.from_bytes(os.urandom(4), 'little')
+        self.pages = collections.deque(maxlen=max(1, int(LIVE_BUFFER_SECONDS * 50 / self.PAGE_PACKETS)))
+        self.next_index = 0  # 次に積むページの通し番号
+        self.sequence = 2  # Oggのページ番号（0と1はヘッダー）
+        self.granule = OPUS_PRE_SKIP
+        self.pending = bytearray()  # 20msに満たないPCM
+        self.packets = []  # ページにまとめる前のOpusパケット
+        self.encoder = None
+        self.listeners = 0
+        self.closed = False
+        self.waiters = set()
+        self.lock = threading.Lock()
+        head, tags = opus_header_packets()
+        self.header = bytes(ogg_page(self.serial, 0, 0, [head], 0x02) + ogg_page(self.serial, 1, 0, [tags]))
+
+    def feed(self, pcm):
+        """ミックスのPCMを受け取る（書き出しスレッドから呼ばれる）"""
+        if not self.listeners:
+            return
+        frame_bytes = self.FRAME_SAMPLES * FRAME_BYTES
+        added = False
+        with self.lock:
+            if self.encoder is None:
+                self.encoder = discord.opus.Encoder()
+            self.pending += pcm
+            while len(self.pending) >= frame_bytes:
+                self.packets.append(self.encoder.encode(bytes(self.pending[:frame_bytes]), self.FRAME_SAMPLES))
+                del self.pending[:frame_bytes]
+                self.granule += self.FRAME_SAMPLES
+                if len(self.packets) >= self.PAGE_PACKETS:
+                    page = bytes(ogg_page(self.serial, self.sequence, self.granule, self.packets))
+                    self.pages.append((self.next_index, page))
+                    self.next_index += 1
+                    self.sequence += 1
+                    self.packets = []
+                    added = True
+        if added:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def subscribe(self):
+        """聴取者を登録し、最初に読むページの直前の番号を返す"""
+        with self.lock:
+            if not self.listeners:
+                # 誰も聴いていない間はエンコードしていないので、古いページは捨てる
+                self.pages.clear()
+                self.pending.clear()
+                self.packets = []
+            self.listeners += 1
+            return self.next_index - 1
+
+    def unsubscribe(self):
+        with self.lock:
+            self.listeners -= 1
+
+    async def pages_after(self, index):
+        """index より後のページを (最後のページの番号, ページの一覧) で返す。無ければ届くまで待つ"""
+        while not self.closed:
+            with self.lock:
+                pages = [page for page_index, page in self.pages if page_index > index]
+                if pages:
+                    return self.next_index - 1, pages
+            waiter = self.loop.create_future()
+            self.waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter, 5)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiters.discard(waiter)
+        return index, []
+
+    def close(self):
+        self.closed = True
+        self.loop.call_soon_threadsafe(self._wake)
+
+# サーバーID -> LiveTap（録音中のサーバーだけ）
+live_taps = {}
+
+def live_url(guild_id):
+    return f"http://{LIVE_HOST}:{LIVE_PORT + (SHARD_ID or 0)}/live/{guild_id}.ogg"
+
+async def start_live_server():
+    """LIVE_PORT で録音中のミックスを配信する（シャードごとにポートをずらす）"""
+    from aiohttp import web
+    
+    async def handle_index(request):
+        return web.json_response({str(guild_id): live_url(guild_id) for guild_id, tap in live_taps.items() if not tap.closed})
+    
+    async def handle_live(request):
+        tap = live_taps.get(int(request.match_info["guild_id"]))
+        if tap is None or tap.closed:
+            raise web.HTTPNotFound(text="このサーバーは録音していません")
+        response = web.StreamResponse(headers={"Content-Type": "audio/ogg", "Cache-Control": "no-cache"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        index = tap.subscribe()
+        try:
+            await response.write(tap.header)
+            while not tap.closed:
+                index, pages = await tap.pages_after(index)
+                for page in pages:
+                    await response.write(page)
+        except ConnectionResetError:
+            pass  # 聴取者が切断した
+        finally:
+            tap.unsubscribe()
+        return response
+    
+    app = web.Application()
+    app.router.add_get("/live", handle_index)
+    app.router.add_get(r"/live/{guild_id:\d+}.ogg", handle_live)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = LIVE_PORT + (SHARD_ID or 0)
+    await web.TCPSite(runner, LIVE_HOST, port).start()
+    logger.info(f"録音中のミックスを配信しています: http://{LIVE_HOST}:{port}/live")
+
+class SegmentStream:
+    """1セグメント分の合成とエンコードを担当する
+
+    受け取ったPCMを MIX_LATENCY 分だけ合成してから
+    STREAM_FLUSH_INTERVAL ごとに常駐するffmpegの標準入力へ書き込む。
+    マルチトラックモードではユーザーごとに別のffmpegへ書き込むため、
+    各トラックのエンコードは別プロセスとして並列に進む。
+    Opusのパススルーでは受信したパケットをデコードせずにOggへ書き出す。
+    セグメントの確定は finish() で行う（ブロックするのでスレッドから呼ぶこと）。
+    """
+
+    def __init__(self, filename, start_time=None, multitrack=False, passthrough=False, guild=None,
+                 debug_capture=False, spool=False, live=None, levelers=None, on_budget=None, output_format=None):
+        self.filename = filename
+        self.output_format = output_format  # None なら OUTPUT_FORMAT
+        self.multitrack = multitrack
+        self.passthrough = passthrough
+        self.debug_capture = debug_capture  # ミックスをデバッグ用WAVにも書き出す
+        self.live = live  # ミックスを配信する LiveTap
+        self.guild = guild  # 表示名の解決に使う
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self.outputs = {}  # ミックスは None、マルチトラックは user_id -> (PCMMixer, SilenceGate, PCMEncoder)
+        self.opus_tracks = {}  # パススルー時の user_id -> [OggOpusWriter, 最初のフレーム位置]
+        self.user_bytes = {}  # ユーザーごとの受信バイト数
+        self.end_time = None  # 区切られた時刻（rotate時に mark_end() で設定）
+        self.debug_wav = None
+        self.debug_wav_path = None
+        self.spool_enabled = spool
+        self.spool = None  # SegmentSpool（最初のパケットで作成）
+        self.recovered_spool = None  # スプールから復旧したセグメントの元スプール
+        self.saved_path = None  # 保存できたファイル（変換に失敗した場合は代わりのWAV）
+        self.partial = None  # 途中までしか変換できなかった場合の [(ファイル, 秒数), ...]
+        # ユーザーごとの LoudnessLeveler（セグメントをまたいで音量が跳ねないよう、シンクから共有する）
+        self.levelers = levelers if levelers is not None else {}
+        self.last_speech = self.start_time  # 最後に誰かが話していた時刻（perf_counter基準）
+        self.on_budget = on_budget  # SEGMENT_MAX_BYTES に達したときに（一度だけ）呼ぶ関数
+        self.budget_bytes = 0  # SEGMENT_MAX_BYTES と比べる、書き出したバイト数
+        self.budget_reached = False
+        self.opus_dropped_frames = 0  # パススルーで確定後に届いて書けなかったフレーム数
+        self.opus_clamped_frames = 0  # パススルーで開始より前の音声として先頭に寄せたフレーム数
+        self.result = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._outputs_lock = threading.Lock()
+        self._finish_lock = threading.Lock()
+
+    @property
+    def output_path(self):
+        """保存先として通知するパス（マルチトラックではマニフェスト）"""
+        if self.multitrack:
+            return os.path.splitext(self.filename)[0] + ".json"
+        return self.filename
+
+    @property
+    def bytes_streamed(self):
+        return (sum(encoder.bytes_written for _, _, encoder in list(self.outputs.values()))
+                + sum(writer.bytes_written for writer, _ in list(self.opus_tracks.values())))
+
+    @property
+    def boundary_dropped_frames(self):
+        """区切りの MIX_LATENCY 以内で捨てたフレーム数（パススルーでは確定後に届いたパケット）"""
+        return self.opus_dropped_frames + sum(mixer.boundary_dropped for mixer, _, _ in list(self.outputs.values()))
+
+    @property
+    def clamped_frames(self):
+        """セグメントの開始より前の音声として先頭に寄せたフレーム数"""
+        return self.opus_clamped_frames + sum(mixer.clamped_frames for mixer, _, _ in list(self.outputs.values()))
+
+    def mark_end(self, end_time):
+        """区切られた時刻を設定する（以降は区切り時刻より先を書き出さない）"""
+        self.end_time = end_time
+        end_frame = int((end_time - self.start_time) * SAMPLE_RATE)
+        for mixer, _, _ in list(self.outputs.values()):
+            mixer.mark_boundary(end_frame)
+
+    @property
+    def duration(self):
+        """書き出した音声の長さ（秒）。マルチトラックでは最後に終わるトラックまでの長さ"""
+        ends = [0.0]
+        for key, (mixer, _, encoder) in list(self.outputs.items()):
+            offset = mixer.first_frame if key is not None and mixer.first_frame is not None else 0
+            ends.append((offset + encoder.bytes_written / FRAME_BYTES) / SAMPLE_RATE)
+        for writer, first_frame in list(self.opus_tracks.values()):
+            ends.append((first_frame + max(0, writer.granule - writer.PRE_SKIP)) / SAMPLE_RATE)
+        return max(ends)
+
+    def silent_for(self, now=None):
+        """全員が話していない時間（秒）"""
+        return (now if now is not None else time.perf_counter()) - self.last_speech
+
+    @property
+    def is_silent(self):
+        """発言が一度も検出されなかったか"""
+        if self.passthrough:
+            return not self.opus_tracks
+        return all(not gate.speech_frames for _, gate, _ in list(self.outputs.values()))
+
+    def track_filename(self, user, ext=None):
+        base, default_ext = os.path.splitext(self.filename)
+        return f"{base}_{user}{ext or default_ext}"
+
+    def start(self):
+        """書き込みスレッドを起動する（二重起動しない）"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._pump, name="segment-stream", daemon=True)
+            self._thread.start()
+
+    def _output(self, key):
+        output = self.outputs.get(key)
+        if output is None:
+            with self._outputs_lock:
+                output = self.outputs.get(key)
+                if output is None:
+                    if key is None:
+                        output = (PCMMixer(start_time=self.start_time), SilenceGate(), PCMEncoder(self.filename, self.output_format))
+                    else:
+                        # トラックは最初の発言から始め、先頭の無音は含めない
+                        output = (PCMMixer(start_time=self.start_time, trim_start=True),
+                                  SilenceGate(), PCMEncoder(self.track_filename(key), self.output_format))
+                    if self.end_time is not None:
+                        output[0].mark_boundary(int((self.end_time - self.start_time) * SAMPLE_RATE))
+                    self.outputs[key] = output
+        return output
+
+    def add(self, user, data, receive_time=None, timestamp=None, packet=None):
+        self.user_bytes[user] = self.user_bytes.get(user, 0) + len(data)
+        if packet is not None and self.spool_enabled:
+            if self.spool is None:
+                self.spool = SegmentSpool.create(self)
+            self.spool.append(user, receive_time - self.start_time, timestamp, packet)
+        if data:
+            samples = np.frombuffer(data, dtype='<i2').astype(np.float32)
+            if np.sqrt(np.mean(samples * samples)) >= SPEECH_THRESHOLD:
+                self.last_speech = receive_time if receive_time is not None else time.perf_counter()
+        if NORMALIZE_LOUDNESS:
+            leveler = self.levelers.get(user)
+            if leveler is None:
+                leveler = self.levelers[user] = LoudnessLeveler()
+            data = leveler.process(data)
+        mixer, _, _ = self._output(user if self.multitrack else None)
+        mixer.add(user, data, receive_time, timestamp)
+
+    def add_opus(self, user, packet, receive_time, timestamp):
+        """受信したOpusパケットをそのままユーザーのトラックへ書き込む（受信スレッドから呼ばれる）"""
+        self.user_bytes[user] = self.user_bytes.get(user, 0) + len(packet)
+        if len(packet) > OPUS_SILENCE_BYTES:
+            self.last_speech = receive_time
+        self._count_budget(len(packet))
+        track = self.opus_tracks.get(user)
+        if track is None:
+            arrived = int((receive_time - self.start_time) * SAMPLE_RATE) - opus_packet_samples(packet)
+            if arrived < 0:
+                self.opus_clamped_frames += min(-arrived, opus_packet_samples(packet))
+            track = self.opus_tracks[user] = [OggOpusWriter(self.track_filename(user, '.ogg')), max(0, arrived)]
+        with self._finish_lock:
+            if self.result is None:
+                track[0].write(packet, timestamp, receive_time)
+            else:
+                self.opus_dropped_frames += opus_packet_samples(packet)
+
+    def _pump(self):
+        last_sync = time.monotonic()
+        while not self._stop.wait(STREAM_FLUSH_INTERVAL):
+            # 書き出しが止まるとバッファからはみ出した音声が捨てられるので、エラーが出ても続ける
+            try:
+                self.flush(time.perf_counter() - MIX_LATENCY)
+                if time.monotonic() - last_sync >= SPOOL_FSYNC_INTERVAL:
+                    last_sync = time.monotonic()
+                    self._sync()
+            except Exception as e:
+                logger.error(f"セグメントの書き出し中にエラーが発生しました: {e}", exc_info=True)
+
+    def flush(self, until):
+        """until（perf_counter基準の時刻）までを合成してエンコーダへ書き込む"""
+        # 区切られた後は区切り時刻より先を書き出さない（残りは finish() で書き出す）
+        if self.end_time is not None:
+            until = min(until, self.end_time)
+        until_frame = int((until - self.start_time) * SAMPLE_RATE)
+        for key, (mixer, gate, encoder) in list(self.outputs.items()):
+            self._drain(key, mixer, gate, encoder, until_frame)
+
+    def _drain(self, key, mixer, gate, encoder, until_frame):
+        """until_frame までを書き出す（間が空いた場合はバッファ1つ分ずつ繰り返す）"""
+        while mixer.flushed < until_frame:
+            pcm = mixer.pop(until_frame)
+            if not pcm:
+                break
+            self._write(key, encoder, gate.process(pcm))
+
+    def _sync(self):
+        """スプールとパススルーのOggをディスクへ確実に書き込む"""
+        if self.spool is not None:
+            self.spool.sync()
+        with self._finish_lock:
+            if self.result is None:
+                for writer, _ in list(self.opus_tracks.values()):
+                    writer.sync()
+
+    def _count_budget(self, size):
+        if self.on_budget is None:
+            return
+        self.budget_bytes += size
+        if not self.budget_reached and self.budget_bytes >= SEGMENT_MAX_BYTES:
+            self.budget_reached = True
+            self.on_budget()
+
+    def _write(self, key, encoder, pcm):
+        if not pcm:
+            return
+        encoder.write(pcm)
+        self._count_budget(len(pcm))
+        if key is None and self.live is not None and not self.live.closed:
+            try:
+                self.live.feed(pcm)
+            except Exception as e:
+                # 配信の不具合で録音を止めない（タップを閉じて以降は渡さない）
+                logger.error(f"ライブ配信のエンコードに失敗したため、配信を停止します: {e}", exc_info=True)
+                self.live.close()
+        if key is None and self.debug_capture:
+            if self.debug_wav is None:
+                self._open_debug_wav()
+            self.debug_wav.writeframes(pcm)
+
+    def _open_debug_wav(self):
+        # デバッグ用にもWAVファイルを保存（変換失敗時の代替にも使う）
+        os.makedirs(DEBUG_DIR, exist_ok=True)
+        guild_id = self.guild.id if self.guild is not None else 0
+        self.debug_wav_path = os.path.join(DEBUG_DIR, f"debug_{guild_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.wav")
+        self.debug_wav = wave.open(self.debug_wav_path, 'wb')
+        self.debug_wav.setnchannels(CHANNELS)
+        self.debug_wav.setsampwidth(2)  # 16-bit PCM
+        self.debug_wav.setframerate(SAMPLE_RATE)
+
+    def finish(self):
+        """残りのデータを書き出してffmpegを終了させる。成功したかを返す"""
+        with self._finish_lock:
+            if self.result is not None:
+                return self.result
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+            for key, (mixer, gate, encoder) in list(self.outputs.items()):
+                # 区切られたミックスは区切り時刻まで無音で埋め、次のセグメントと隙間なくつなげる
+                end_frame = mixer.end_frame()
+                if key is None and self.end_time is not None:
+                    end_frame = max(end_frame, int((self.end_time - self.start_time) * SAMPLE_RATE))
+                self._drain(key, mixer, gate, encoder, end_frame)
+                self._write(key, encoder, gate.flush())
+                guild = metric_guild(self.guild)
+                if mixer.late_frames:
+                    metrics.inc("recorder_dropped_frames_total", mixer.late_frames, guild=guild, reason="late")
+                if mixer.overflow_frames:
+                    metrics.inc("recorder_dropped_frames_total", mixer.overflow_frames, guild=guild, reason="overflow")
+            
+            if self.debug_wav is not None:
+                self.debug_wav.close()
+                logger.info(f"デバッグ用WAVファイルを保存: {self.debug_wav_path}")
+                enforce_debug_retention(keep=self.debug_wav_path)
+            
+            # 各ffmpegは既に並列で動いているので、ここでは順に終了を待つだけ
+            results = [encoder.close() for _, _, encoder in list(self.outputs.values())]
+            results += [writer.close() for writer, _ in list(self.opus_tracks.values())]
+            if self.spool is not None:
+                self.spool.close()
+            self.result = any(results)
+            return self.result
+
+    def write_manifest(self, display_names):
+        """マルチトラックのトラック一覧（開始位置・表示名）をJSONで書き出す"""
+        duration = (self.end_time or time.perf_counter()) - self.start_time
+        tracks = []
+        for user, (mixer, _, encoder) in sorted(self.outputs.items()):
+            tracks.append({
+                "user_id": user,
+                "display_name": display_names.get(user),
+                "file": os.path.basename(encoder.filename),
+                "offset": mixer.first_frame / SAMPLE_RATE if mixer.first_frame is not None else 0.0,
+                "duration": encoder.bytes_written / FRAME_BYTES / SAMPLE_RATE,
+                "status": "failed" if encoder.failed else "ok"
+            })
+        for user, (writer, first_frame) in sorted(self.opus_tracks.items()):
+            tracks.append({
+                "user_id": user,
+                "display_name": display_names.get(user),
+                "file": os.path.basename(writer.filename),
+                "offset": first_frame / SAMPLE_RATE,
+                "duration": (writer.granule - writer.PRE_SKIP) / SAMPLE_RATE,
+                "status": "failed" if writer.failed else "ok"
+            })
+        manifest = {
+            "segment": os.path.basename(self.filename),
+            "sample_rate": SAMPLE_RATE,
+            "channels": CHANNELS,
+            "duration": duration,
+            "tracks": tracks
+        }
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    def write_silence_index(self):
+        """詰めた無音区間の一覧をサイドカーJSONに書き出す（位置は各出力の先頭からの秒）"""
+        index = {
+            "threshold_db": SILENCE_THRESHOLD_DB,
+            "keep_seconds": SILENCE_KEEP_SECONDS,
+            "outputs": {
+                "mix" if key is None else str(key): gate.summary()
+                for key, (_, gate, _) in sorted(self.outputs.items(), key=lambda item: str(item[0]))
+            }
+        }
+        path = os.path.splitext(self.filename)[0] + ".silence.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        return path
+
+class SegmentSpool:
+    """セグメントの受信パケット（デコード前のOpus）を追記専用ファイルに書き出す
+
+    クラッシュや強制終了でエンコード前の音声が失われないよう、
+    ユーザーごとのスプールファイルへバッファ付きで追記し、
+    SPOOL_FSYNC_INTERVAL ごとに fsync する。
+    セグメントの保存に成功したら discard() で削除し、
+    残っていたスプールは起動時に recover_spools() で復旧する。
+    """
+
+    RECORD = struct.Struct('<dIH')  # セグメント先頭からの秒, RTPタイムスタンプ, パケット長
+
+    def __init__(self, meta_path, meta):
+        self.meta_path = meta_path
+        self.meta = meta
+        self.files = {}  # user_id -> ファイル
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, stream):
+        """セグメントのスプールを作成し、復旧に必要な情報をJSONで書いておく"""
+        session_dir, name = os.path.split(stream.filename)
+        spool_dir = os.path.join(session_dir, ".spool")
+        os.makedirs(spool_dir, exist_ok=True)
+        meta = {
+            "filename": stream.filename,
+            "multitrack": stream.multitrack,
+            "guild_id": stream.guild.id if stream.guild is not None else None,
+            "started_at": time.time() - (time.perf_counter() - stream.start_time)
+        }
+        meta_path = os.path.join(spool_dir, os.path.splitext(name)[0] + ".spool.json")
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls(meta_path, meta)
+
+    def user_path(self, user):
+        return self.meta_path[:-len(".spool.json")] + f"_{user}.spool"
+
+    def append(self, user, offset, timestamp, packet):
+        with self.lock:
+            file = self.files.get(user)
+            if file is None:
+                file = self.files[user] = open(self.user_path(user), 'ab', buffering=64 * 1024)
+            file.write(self.RECORD.pack(offset, timestamp, len(packet)) + bytes(packet))
+
+    def sync(self):
+        with self.lock:
+            for file in self.files.values():
+                file.flush()
+                os.fsync(file.fileno())
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files.clear()
+
+    def discard(self):
+        """保存が終わったスプールを削除する"""
+        self.close()
+        for path in glob.glob(glob.escape(self.meta_path[:-len(".spool.json")]) + "_*.spool") + [self.meta_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @classmethod
+    def read_records(cls, path):
+        """スプールファイルから (秒, RTPタイムスタンプ, パケット) を読み出す（途中で切れた末尾は捨てる）"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + cls.RECORD.size <= len(data):
+            offset, timestamp, length = cls.RECORD.unpack_from(data, position)
+            position += cls.RECORD.size
+            if position + length > len(data):
+                break
+            yield offset, timestamp, data[position:position + length]
+            position += length
+
+def replay_spool(meta_path, guild=None, filename=None, output_format=None):
+    """スプールからセグメントを組み立て直す（スレッドで実行される）
+
+    パケットを受信時刻の順にデコードして通常と同じ合成・エンコードに流し、
+    確定前の SegmentStream を返す。filename を省略すると元のファイル名に _recovered を付ける。
+    """
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    spool = SegmentSpool(meta_path, meta)
+    if filename is None:
+        base, ext = os.path.splitext(meta["filename"])
+        filename = f"{base}_recovered{ext}"
+    stream = SegmentStream(filename, start_time=0.0, multitrack=meta["multitrack"],
+                           guild=guild, output_format=output_format)
+    stream.recovered_spool = spool
+    
+    records = []
+    for path in glob.glob(glob.escape(meta_path[:-len(".spool.json")]) + "_*.spool"):
+        user = int(path[:-len(".spool")].rsplit("_", 1)[1])
+        records.extend((offset, user, timestamp, packet)
+                       for offset, timestamp, packet in SegmentSpool.read_records(path))
+    records.sort(key=lambda record: record[0])
+    
+    decoders = {}
+    last_flush = 0.0
+    for offset, user, timestamp, packet in records:
+        # 合成バッファはセグメント全体を持てないので、時刻が進んだら少しずつ書き出す
+        # （長い無音の後のパケットがバッファからはみ出さないよう、足し込む前に書き出す）
+        if offset - last_flush >= STREAM_FLUSH_INTERVAL:
+            stream.flush(offset - MIX_LATENCY)
+            last_flush = offset
+        decoder = decoders.get(user)
+        if decoder is None:
+            decoder = decoders[user] = discord.opus.Decoder()
+        stream.add(user, decoder.decode(packet), offset, timestamp)
+    return stream
+
+def rebuild_wav_from_spool(spool, path, guild=None):
+    """スプールからセグメント全体をWAVに書き出し直す（スレッドで実行される）
 
-# 録音セッション情報を保持する辞書
-recording_sessions = {}
+    ffmpegが途中で落ちたセグメントを、落ちる前の部分も含めて path に保存する。成功したかを返す。
+    """
+    base, ext = os.path.splitext(path)
+    temp_path = f"{base}_rebuild{ext}"
+    stream = replay_spool(spool.meta_path, guild, filename=temp_path, output_format='wav')
+    if not stream.finish() or not os.path.exists(temp_path):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+    os.replace(temp_path, path)
+    return True
 
-@bot.event
-async def on_ready():
-    logger.info(f'{bot.user} としてログインしました')
-    logger.info(f'インテント設定: {bot.intents}')
-    check_voice_connections.start()
-    logger.info('監視ループを開始しました')
-    print('------')
+async def recover_spools():
+    """前回の実行で残ったスプールを復旧してエンコードキューに渡す"""
+    loop = asyncio.get_running_loop()
+    active = {session.session_dir for session in recording_sessions.values()}
+    for meta_path in glob.glob(os.path.join(glob.escape(RECORDINGS_DIR), "*", ".spool", "*.spool.json")):
+        session_dir = os.path.dirname(os.path.dirname(meta_path))
+        if session_dir in active:
+            continue
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                guild_id = json.load(f).get("guild_id")
+            if not owns_guild(guild_id or 0):
+                continue  # 他のシャードが担当するサーバー（サーバー不明のものはシャード0が扱う）
+            guild = bot.get_guild(guild_id) if guild_id is not None else None
+            stream = await loop.run_in_executor(None, replay_spool, meta_path, guild)
+        except Exception as e:
+            logger.error(f"スプールの復旧に失敗しました: {meta_path}: {e}")
+            continue
+        logger.info(f"前回の実行で残ったスプールを復旧します: {meta_path}")
+        await encode_queue.submit(stream, stream.filename, f"復旧 {os.path.basename(stream.filename)}")
 
-@tasks.loop(seconds=60)
-async def check_voice_connections():
-    """音声接続の状態を定期的に確認"""
-    for guild_id, session in list(recording_sessions.items()):
-        if not session["voice_client"].is_connected():
-            try:
-                # 再接続を試みる
-                channel = session["voice_client"].channel
-                session["voice_client"] = await channel.connect()
-                logger.info(f"{channel.name}に再接続しました")
-            except Exception as e:
-                logger.error(f"再接続に失敗しました: {e}")
-                # 再接続に失敗した場合はセッションを終了
-                session["running"] = False
-                if guild_id in recording_sessions:
-                    del recording_sessions[guild_id]
+class StreamingSink(discord.sinks.Sink):
+    """受信したPCMを現在のセグメントへ流し込むシンク
 
-@bot.event
-async def on_error(event, *args, **kwargs):
-    """エラーハンドリング"""
-    with open('err.log', 'a') as f:
-        if event == 'on_message':
-            f.write(f'Unhandled message: {args[0]}\n')
-        else:
-            f.write(f'Unhandled event: {event}\n')
-    logger.error(f'An error occurred in {event}')
+    セグメントの区切りでは rotate() で書き込み先を新しい SegmentStream に
+    切り替えるだけなので、録音を止めずに次のセグメントへ移れる。
+    音声データはメモリに溜め込まず、常駐するffmpegへ直接流す。
+    """
 
-@bot.event
-async def on_command_error(ctx, error):
-    """コマンドエラーのハンドリング"""
-    if isinstance(error, commands.CommandInvokeError):
-        logger.error(f'コマンド実行エラー: {error.original}')
-        await ctx.send(f"エラーが発生しました: {error.original}")
-    else:
-        logger.error(f'コマンドエラー: {error}')
-        await ctx.send(f"コマンドエラー: {error}")
+    def __init__(self, filename, *, multitrack=False, guild=None, live=None, on_budget=None, filters=None):
+        super().__init__(filters=filters)
+        self.multitrack = multitrack
+        self.live = live  # 各セグメントのミックスを渡す LiveTap
+        self.levelers = {}  # ユーザーごとの LoudnessLeveler（セグメントをまたいで引き継ぐ）
+        self.on_budget = on_budget  # セグメントがサイズの上限に達したときに呼ぶ関数
+        # ミックスにはデコードが必要なので、パススルーはマルチトラックのときだけ
+        self.passthrough = multitrack and OUTPUT_FORMAT == 'opus' and OPUS_PASSTHROUGH
+        self.guild = guild
+        self.stream = self._new_stream(filename)
+        self._lock = threading.Lock()
 
-@bot.event
-async def on_voice_state_update(member, before, after):
-    """音声状態の変更を監視して、切断された場合に対応する"""
-    if before.channel is not None and after.channel is None:
-        # ユーザーが切断した場合
-        for guild_id, session in list(recording_sessions.items()):
-            if session["voice_client"].channel == before.channel:
-                if len(before.channel.members) <= 1:  # ボットだけが残った場合
-                    logger.info(f"全員が退出したため、{before.channel.name}での録音を停止します")
-                    session["running"] = False
-                    try:
-                        session["voice_client"].stop_recording()
-                        await session["voice_client"].disconnect()
-                    except Exception as e:
-                        logger.error(f"切断中にエラーが発生しました: {e}")
-                    
-                    if guild_id in recording_sessions:
-                        del recording_sessions[guild_id]
+    def init(self, vc):
+        super().init(vc)
+        self.stream.start()
 
-@bot.command(name='record')
-async def record(ctx):
-    """音声チャンネルの録音を開始します"""
-    try:
-        # ユーザーが音声チャンネルに接続しているか確認
-        if ctx.author.voice is None:
-            await ctx.send("音声チャンネルに接続してから実行してください。")
+    @discord.sinks.Filters.container
+    def write(self, data, user):
+        with self._lock:
+            stream = self.stream
+        stream.add(user, data)
+
+    def write_packet(self, user, data, receive_time, timestamp, packet=None):
+        """RecorderVoiceClientから、タイムスタンプ付きでPCM（とデコード前のOpus）を受け取る"""
+        if self.filtered_users and user not in self.filtered_users:
             return
-            
-        voice_channel = ctx.author.voice.channel
-        
-        # 既に録音中かチェック
-        if ctx.guild.id in recording_sessions:
-            await ctx.send("既に録音中です。`!stop`で録音を停止できます。")
+        with self._lock:
+            stream = self.stream
+        stream.add(user, data, receive_time, timestamp, packet)
+
+    def _new_stream(self, filename):
+        # デバッグ用WAVの設定はセグメントごとに確認する（!debug の切り替えを次のセグメントから反映）
+        debug_capture = debug_capture_enabled(self.guild.id if self.guild is not None else None)
+        # パススルーのOggはそのままディスクに書かれるのでスプールしない
+        return SegmentStream(filename, multitrack=self.multitrack, passthrough=self.passthrough,
+                             guild=self.guild, debug_capture=debug_capture,
+                             spool=SPOOL_ENABLED and not self.passthrough, live=self.live,
+                             levelers=self.levelers, on_budget=self.on_budget)
+
+    def write_opus(self, user, packet, receive_time, timestamp):
+        """RecorderVoiceClientから、デコード前のOpusパケットを受け取る"""
+        if self.filtered_users and user not in self.filtered_users:
             return
-        
-        # 録音用ディレクトリの作成
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        session_dir = os.path.join(RECORDINGS_DIR, f"{ctx.guild.id}_{timestamp}")
-        os.makedirs(session_dir, exist_ok=True)
-        
-        # 音声チャンネルに接続
-        voice_client = await voice_channel.connect()
-        
-        # 録音セッション情報を保存
-        recording_sessions[ctx.guild.id] = {
-            "voice_client": voice_client,
-            "session_dir": session_dir,
-            "segment": 1,
-            "running": True
-        }
-        
-        # 保存先情報も含めたメッセージを表示
-        await ctx.send(f"{voice_channel.name} での録音を開始しました。\n"
-                       f"10分ごとにファイルを分割して保存します。\n"
-                       f"保存先: {session_dir}")
-        
-        logger.info(f"{ctx.guild.name}の{voice_channel.name}で録音を開始しました")
-        logger.info(f"チャンネルユーザー数: {len(voice_channel.members)}")
-        
-        # 録音ループを開始
-        asyncio.create_task(recording_loop(ctx))
-    
-    except Exception as e:
-        logger.error(f"録音開始中にエラーが発生しました: {e}")
-        await ctx.send(f"録音開始中にエラーが発生しました: {e}")
+        with self._lock:
+            stream = self.stream
+        stream.add_opus(user, packet, receive_time, timestamp)
+
+    def rotate(self, filename):
+        """書き込み先を新しいセグメントに切り替え、終わったセグメントを返す
 
-async def recording_loop(ctx):
-    """10分ごとに録音を区切るループ処理"""
+        切り替えはロックの中で参照を差し替えるだけなので、受信したパケットは
+        必ずどちらかのセグメントに入る（区切りで失われる音声の長さは boundary_loss_recorder で数える）。
+        """
+        stream = self._new_stream(filename)
+        with self._lock:
+            boundary = time.perf_counter()
+            stream.start_time = boundary
+            old_stream = self.stream
+            old_stream.mark_end(boundary)
+            self.stream = stream
+        stream.start()
+        return old_stream
+
+    def cleanup(self):
+        # 確定処理は SegmentStream.finish() で行う（録音スレッドを止めないため）
+        self.finished = True
+
+def debug_capture_enabled(guild_id):
+    """デバッグ用WAVを保存するかどうか"""
+    return DEBUG_CAPTURE or guild_id in debug_capture_guilds
+
+def enforce_debug_retention(keep=None):
+    """デバッグ用WAVが上限を超えたら、最後に使われたのが古いものから削除する"""
     try:
-        guild_id = ctx.guild.id
-        
-        while guild_id in recording_sessions:
-            session = recording_sessions[guild_id]
-            
-            if not session["running"]:
-                break
-                
-            segment = session["segment"]
-            # ファイル名をMP3に変更
-            filename = f"{session['session_dir']}/segment_{segment}.mp3"
-            
-            # 録音シンクの準備
-            sink = discord.sinks.WaveSink()
-            
+        entries = []
+        for name in os.listdir(DEBUG_DIR):
+            path = os.path.join(DEBUG_DIR, name)
+            if not name.endswith('.wav') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+    except OSError as e:
+        logger.error(f"デバッグ用WAVの確認に失敗しました: {e}")
+        return
+    entries.sort()
+    count = len(entries)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if count <= DEBUG_MAX_FILES and total <= DEBUG_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            # 他のセグメントが書き込み中の場合など
+            logger.warning(f"デバッグ用WAVを削除できませんでした: {path}: {e}")
+            continue
+        count -= 1
+        total -= size
+        logger.info(f"デバッグ用WAVの上限を超えたため削除しました: {path}")
+
+# ユーザーID -> 表示名（ボイスチャンネルを抜けてキャッシュから消えたメンバーの名前も引けるように）
+display_name_cache = collections.OrderedDict()
+DISPLAY_NAME_CACHE_SIZE = 10000
+
+def remember_display_name(member):
+    display_name_cache[member.id] = member.display_name
+    display_name_cache.move_to_end(member.id)
+    while len(display_name_cache) > DISPLAY_NAME_CACHE_SIZE:
+        display_name_cache.popitem(last=False)
+
+def resolve_display_names(guild, user_ids):
+    """ユーザーIDから表示名を引く（見つからない場合は None）"""
+    names = {}
+    for user_id in user_ids:
+        member = guild.get_member(int(user_id)) if guild is not None else None
+        if member is not None:
+            remember_display_name(member)
+        names[user_id] = member.display_name if member else display_name_cache.get(int(user_id))
+    return names
+
+async def fetch_display_names(guild, user_ids):
+    """resolve_display_names で見つからなかったメンバーをAPIから取得して表示名を引く"""
+    names = resolve_display_names(guild, user_ids)
+    for user_id, name in names.items():
+        if name is None and guild is not None:
             try:
-                session["voice_client"].start_recording(
-                    sink,
-                    finished_callback,
-                    ctx
-                )
-                
-                # Discord接続の状態を確認
-                logger.info(f"音声接続状態: 接続={session['voice_client'].is_connected()}, 再生中={session['voice_client'].is_playing()}")
-                logger.info(f"音声チャンネルのユーザー数: {len(session['voice_client'].channel.members)}")
-                
-                # 指定時間待機
-                logger.info(f"{ctx.guild.name}: セグメント{segment}の録音を開始しました")
-                
-                # 指定時間待機しながら、一定間隔で接続状態を確認
-                for _ in range(RECORDING_LENGTH // 10):
-                    if not (guild_id in recording_sessions and 
-                            recording_sessions[guild_id]["running"] and 
-                            recording_sessions[guild_id]["voice_client"].is_connected()):
-                        logger.warning(f"{ctx.guild.name}: 録音が中断されました")
-                        break
-                    await asyncio.sleep(10)
-                
-                if not (guild_id in recording_sessions and recording_sessions[guild_id]["running"]):
-                    break
-                    
-                # 録音を停止して保存
-                if guild_id in recording_sessions and recording_sessions[guild_id]["voice_client"].is_connected():
-                    session["voice_client"].stop_recording()
-                    success = await save_recording_as_mp3(sink, filename)
-                    
-                    if success:
-                        session["segment"] += 1
-                        await ctx.send(f"セグメント {segment} を保存しました。\n保存先: {filename}")
-                        logger.info(f"{ctx.guild.name}: セグメント{segment}を保存しました")
-                    else:
-                        await ctx.send(f"セグメント {segment} の保存に失敗しました。ログを確認してください。")
-                        logger.error(f"{ctx.guild.name}: セグメント{segment}の保存に失敗")
-            
-            except Exception as e:
-                logger.error(f"録音ループ中にエラーが発生しました: {e}")
-                if guild_id in recording_sessions:
-                    try:
-                        recording_sessions[guild_id]["voice_client"].stop_recording()
-                    except:
-                        pass
-                await ctx.send(f"録音中にエラーが発生しました。再試行します。")
-                await asyncio.sleep(2)  # 少し待機してから再試行
-    
-    except Exception as e:
-        logger.error(f"録音ループ全体でエラーが発生しました: {e}")
-        await ctx.send(f"録音が中断されました: {e}")
+                member = await guild.fetch_member(int(user_id))
+            except discord.HTTPException:
+                continue
+            remember_display_name(member)
+            names[user_id] = member.display_name
+    return names
 
-async def finished_callback(sink, ctx):
-    """録音完了時のコールバック関数"""
-    # この関数は自動停止時に呼ばれない（手動停止時のみ）
-    logger.info(f"{ctx.guild.name}: finished_callbackが呼び出されました")
-    pass
+async def voice_member_names(channel):
+    """ボイスチャンネルにいるユーザー（ボットを除く）の表示名
+
+    メンバーをキャッシュしていなくても、音声状態から取得する。
+    """
+    names = []
+    for user_id in channel.voice_states:
+        member = channel.guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await channel.guild.fetch_member(user_id)
+            except discord.HTTPException:
+                continue
+        if not member.bot:
+            remember_display_name(member)
+            names.append(member.display_name)
+    return names
+
+async def save_recording(stream, filename):
+    """ストリーミング中のセグメントを確定させ、OUTPUT_FORMAT の形式で保存する
+
+    保存できた（または無音で不要だった）場合は、そのセグメントのスプールを削除する。
+    途中までしか変換できなかった場合は、次回の起動時に復旧できるようスプールを残す。
+    """
+    success = await _save_recording(stream, filename)
+    try:
+        await record_segment(stream, filename, success)
+    except Exception as e:
+        logger.error(f"目録への記録に失敗しました: {e}")
+    spool = stream.recovered_spool or stream.spool
+    if spool is not None and ((success and stream.partial is None) or stream.is_silent):
+        await asyncio.get_running_loop().run_in_executor(None, spool.discard)
+    return success
 
-async def save_recording_as_mp3(sink, filename):
-    """録音データをMP3ファイルとして保存する"""
+async def _save_recording(stream, filename):
     try:
         # 音声データの確認と詳細ログ
-        logger.info(f"録音ユーザー数: {len(sink.audio_data)}")
+        logger.info(f"録音ユーザー数: {len(stream.user_bytes)}")
         total_size = 0
         
-        for user_id, audio in sink.audio_data.items():
-            audio.file.seek(0, os.SEEK_END)
-            size = audio.file.tell()
-            audio.file.seek(0)
+        for user_id, size in stream.user_bytes.items():
             total_size += size
             logger.info(f"ユーザーID {user_id} の録音サイズ: {size} バイト")
         
         logger.info(f"合計録音サイズ: {total_size} バイト")
         
-        if not sink.audio_data:
+        # ffmpegの終了待ちはブロックするのでスレッドで実行
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(None, stream.finish)
+        
+        if not stream.user_bytes:
             logger.warning("録音データが空です！")
             return False
             
-        # 録音サイズが小さすぎる場合は処理しない
-        if total_size < 1000:  # 1KB未満
-            logger.warning(f"録音サイズが小さすぎます ({total_size} バイト)。処理をスキップします。")
+        # 無音だけのセグメントは保存しない（エンコーダも起動していない）
+        if stream.is_silent and SKIP_SILENT_SEGMENTS:
+            logger.warning("発言が検出されなかったため、セグメントの保存をスキップします。")
             return False
         
-        # デバッグディレクトリ
-        debug_dir = os.path.join(RECORDINGS_DIR, "debug")
-        os.makedirs(debug_dir, exist_ok=True)
+        if SILENCE_TRIM:
+            index_path = await loop.run_in_executor(None, stream.write_silence_index)
+            logger.info(f"詰めた無音区間の一覧を保存しました: {index_path}")
         
-        # 一時WAVファイル（デバッグ用に保存）
-        debug_wav = os.path.join(debug_dir, f"debug_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.wav")
+        if stream.multitrack:
+            # 表示名はイベントループ上で解決してからマニフェストに書く
+            display_names = resolve_display_names(stream.guild, stream.user_bytes)
+            await loop.run_in_executor(None, stream.write_manifest, display_names)
+            stream.saved_path = stream.output_path
+            logger.info(f"マルチトラックのマニフェストを保存しました: {stream.output_path}（{len(stream.outputs) + len(stream.opus_tracks)}トラック）")
+            return success
         
-        # 一時ディレクトリを使用
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_wav = os.path.join(temp_dir, "temp_recording.wav")
-            
-            # WAVファイルの準備
-            logger.info(f"一時WAVファイルを作成: {temp_wav}")
-            
-            # WAVファイルを作成
-            with wave.open(temp_wav, 'wb') as wav_file:
-                wav_file.setnchannels(CHANNELS)
-                wav_file.setsampwidth(2)  # 16-bit PCM
-                wav_file.setframerate(SAMPLE_RATE)
-                
-                # すべてのユーザーの音声データを処理
-                combined_audio = bytearray()
-                for user_id, audio in sink.audio_data.items():
-                    combined_audio.extend(audio.file.read())
-                    audio.file.seek(0)  # ファイルポインタをリセット
-                
-                wav_file.writeframes(combined_audio)
-            
-            # デバッグ用にもWAVファイルを保存
-            with wave.open(debug_wav, 'wb') as wav_file:
-                wav_file.setnchannels(CHANNELS)
-                wav_file.setsampwidth(2)  # 16-bit PCM
-                wav_file.setframerate(SAMPLE_RATE)
-                
-                # 全ユーザーの音声を再度読み込み
-                combined_audio = bytearray()
-                for user_id, audio in sink.audio_data.items():
-                    combined_audio.extend(audio.file.read())
-                    audio.file.seek(0)  # ファイルポインタをリセット
-                
-                wav_file.writeframes(combined_audio)
-            
-            logger.info(f"デバッグ用WAVファイルを保存: {debug_wav}")
-            
-            # ファイルが正常に作成されたか確認
-            if not os.path.exists(temp_wav) or os.path.getsize(temp_wav) < 1000:
-                logger.error(f"WAVファイルの作成に失敗または小さすぎます: {temp_wav}")
-                return False
-                
-            # FFmpegコマンドの準備
-            # ローカルにあればそのパスを使用、なければシステムのffmpegを使用
-            ffmpeg_exec = FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else 'ffmpeg'
-            
-            ffmpeg_cmd = [
-                ffmpeg_exec, 
-                '-i', temp_wav, 
-                '-codec:a', 'libmp3lame', 
-                '-qscale:a', '2',  # 品質設定 (0-9, 0が最高品質)
-                '-y',  # 既存ファイルを上書き
-                filename
-            ]
-            
-            logger.info(f"実行するFFmpegコマンド: {' '.join(ffmpeg_cmd)}")
-            
-            try:
-                # FFmpegを実行して詳細なエラー出力を取得
-                process = subprocess.run(
-                    ffmpeg_cmd, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE,
-                    check=True  # エラー時に例外を発生させる
-                )
-                logger.info("FFmpeg変換成功")
-            except subprocess.CalledProcessError as e:
-                error_output = e.stderr.decode() if e.stderr else "不明なエラー"
-                logger.error(f"FFmpeg変換エラー: {error_output}")
-                
-                # 失敗した場合はデバッグ用WAVファイルをMP3の代わりに使用
-                import shutil
-                mp3_dir = os.path.dirname(filename)
-                wav_filename = os.path.join(mp3_dir, os.path.basename(filename).replace('.mp3', '.wav'))
-                shutil.copy(debug_wav, wav_filename)
-                logger.info(f"MP3変換に失敗したため、WAVファイルを保存: {wav_filename}")
+        if not success:
+            wav_filename = os.path.splitext(filename)[0] + '.wav'
+            if stream.debug_wav_path is not None and os.path.exists(stream.debug_wav_path):
+                # デバッグ用WAVには全体が入っているので、コピーせずに移動して代わりに使用
+                os.replace(stream.debug_wav_path, wav_filename)
+                stream.saved_path = wav_filename
+                logger.info(f"変換に失敗したため、デバッグ用WAVファイルを保存: {wav_filename}")
                 return True
-            
-            # ファイル確認
-            if os.path.exists(filename):
-                file_size = os.path.getsize(filename)
-                logger.info(f"MP3ファイル {filename} を保存しました。サイズ: {file_size} バイト")
+            encoder = stream.outputs[None][2] if None in stream.outputs else None
+            if encoder is not None and encoder.fallback_filename:
+                if not encoder.fallback_offset:
+                    # ffmpegが起動できなかったので、WAVにセグメント全体が入っている
+                    stream.saved_path = encoder.fallback_filename
+                    logger.info(f"変換に失敗したため、WAVファイルに保存しました: {encoder.fallback_filename}")
+                    return True
+                # ffmpegが途中で落ちたので、WAVには落ちた後の音声しか入っていない
+                spool = stream.recovered_spool or stream.spool
+                if spool is not None:
+                    try:
+                        rebuilt = await loop.run_in_executor(
+                            None, rebuild_wav_from_spool, spool, encoder.fallback_filename, stream.guild)
+                    except Exception as e:
+                        logger.error(f"スプールからのWAVの作り直しに失敗しました: {e}")
+                        rebuilt = False
+                    if rebuilt:
+                        # 途中までの変換結果はWAVに全部入っているので不要
+                        try:
+                            os.remove(filename)
+                        except OSError:
+                            pass
+                        stream.saved_path = encoder.fallback_filename
+                        logger.info(f"変換が途中で失敗したため、スプールからWAVファイルを作り直しました: {encoder.fallback_filename}")
+                        return True
+                # 作り直せない場合は両方のファイルを残し、途中までしか変換できなかったことを記録する
+                head_seconds = encoder.fallback_offset / FRAME_BYTES / SAMPLE_RATE
+                tail_seconds = (encoder.bytes_written - encoder.fallback_offset) / FRAME_BYTES / SAMPLE_RATE
+                stream.partial = [(filename, head_seconds), (encoder.fallback_filename, tail_seconds)]
+                stream.saved_path = encoder.fallback_filename
+                logger.warning(f"変換が途中で失敗しました。{head_seconds:.1f}秒までは {filename}、"
+                               f"以降は {encoder.fallback_filename} に保存されています")
                 return True
-            else:
-                logger.error(f"MP3ファイル {filename} が作成されませんでした")
-                return False
+            logger.error("変換に失敗しました（デバッグ用WAVが無いため代替ファイルはありません）")
+            return False
+        
+        # ファイル確認
+        if os.path.exists(filename):
+            file_size = os.path.getsize(filename)
+            stream.saved_path = filename
+            logger.info(f"録音ファイル {filename} を保存しました。サイズ: {file_size} バイト（PCM {stream.bytes_streamed} バイトから変換）")
+            return True
+        else:
+            logger.error(f"録音ファイル {filename} が作成されませんでした")
+            return False
         
     except Exception as e:
-        logger.error(f"録音保存・MP3変換中にエラーが発生しました: {e}")
+        logger.error(f"録音保存・変換中にエラーが発生しました: {e}")
         import traceback
         logger.error(traceback.format_exc())
         return False
 
+class RecordingCatalog:
+    """セッション・セグメント・話者を記録するSQLiteの目録
+
+    セグメントを保存するたびに追記するので、一覧表示や書き出しは
+    recordings/ を走査せずにここから答える。
+    シャーディング時は複数のプロセスが同じファイルに書き込む（SQLiteのロックに任せる）。
+    ブロックするので、イベントループからはスレッドで呼ぶこと。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            guild_name TEXT,
+            channel_id INTEGER,
+            channel_name TEXT,
+            session_dir TEXT UNIQUE NOT NULL,
+            multitrack INTEGER NOT NULL DEFAULT 0,
+            output_format TEXT,
+            started_at TEXT,
+            ended_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS sessions_guild ON sessions (guild_id, started_at);
+        CREATE TABLE IF NOT EXISTS segments (
+            id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL REFERENCES sessions (id),
+            segment INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL,  -- ok / partial / failed / silent
+            duration REAL NOT NULL DEFAULT 0,
+            size INTEGER NOT NULL DEFAULT 0,
+            saved_at TEXT,
+            UNIQUE (session_id, path)
+        );
+        CREATE TABLE IF NOT EXISTS speakers (
+            segment_id INTEGER NOT NULL REFERENCES segments (id),
+            user_id INTEGER NOT NULL,
+            display_name TEXT,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            track_path TEXT,
+            PRIMARY KEY (segment_id, user_id)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # 使われるまでファイルを作らない
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def _session_id(self, conn, session_dir, guild_id=None, guild_name=None):
+        row = conn.execute("SELECT id FROM sessions WHERE session_dir = ?", (session_dir,)).fetchone()
+        if row is not None:
+            return row["id"]
+        # 目録ができる前のセッション（スプールからの復旧など）は、ここで登録する
+        return conn.execute(
+            "INSERT INTO sessions (guild_id, guild_name, session_dir, output_format) VALUES (?, ?, ?, ?)",
+            (guild_id, guild_name, session_dir, OUTPUT_FORMAT)).lastrowid
+
+    def start_session(self, guild_id, guild_name, channel_id, channel_name, session_dir, multitrack):
+        with self.lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (guild_id, guild_name, channel_id, channel_name, session_dir, "
+                "multitrack, output_format, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (guild_id, guild_name, channel_id, channel_name, session_dir, int(multitrack), OUTPUT_FORMAT, self._now()))
+
+    def end_session(self, session_dir):
+        with self.lock, self._connect() as conn:
+            conn.execute("UPDATE sessions SET ended_at = ? WHERE session_dir = ?", (self._now(), session_dir))
+
+    def add_segment(self, session_dir, segment, path, status, duration, size, speakers, guild_id=None, guild_name=None):
+        """セグメントを記録する。speakers は (user_id, 表示名, 受信バイト数, トラックのパス) の一覧"""
+        with self.lock, self._connect() as conn:
+            session_id = self._session_id(conn, session_dir, guild_id, guild_name)
+            conn.execute(
+                "INSERT OR REPLACE INTO segments (session_id, segment, path, status, duration, size, saved_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, segment, path, status, duration, size, self._now()))
+            segment_id = conn.execute("SELECT id FROM segments WHERE session_id = ? AND path = ?",
+                                      (session_id, path)).fetchone()["id"]
+            conn.execute("DELETE FROM speakers WHERE segment_id = ?", (segment_id,))
+            conn.executemany(
+                "INSERT INTO speakers (segment_id, user_id, display_name, bytes, track_path) VALUES (?, ?, ?, ?, ?)",
+                [(segment_id, *speaker) for speaker in speakers])
+
+    def sessions(self, guild_id=None, limit=10):
+        """新しい順のセッション一覧（保存できたセグメントの数・長さ・サイズ付き）"""
+        with self.lock:
+            return self._connect().execute(
+                "SELECT s.*, COUNT(g.id) AS segments, COALESCE(SUM(g.duration), 0) AS duration, "
+                "COALESCE(SUM(g.size), 0) AS size FROM sessions s "
+                "LEFT JOIN segments g ON g.session_id = s.id AND g.status = 'ok' "
+                "WHERE ? IS NULL OR s.guild_id = ? GROUP BY s.id ORDER BY s.id DESC LIMIT ?",
+                (guild_id, guild_id, limit)).fetchall()
+
+    def session(self, session_id=None, session_dir=None):
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT s.*, COUNT(g.id) AS segments, COALESCE(SUM(g.duration), 0) AS duration, "
+                "COALESCE(SUM(g.size), 0) AS size FROM sessions s "
+                "LEFT JOIN segments g ON g.session_id = s.id AND g.status = 'ok' "
+                "WHERE s.id = ? OR s.session_dir = ? GROUP BY s.id",
+                (session_id, session_dir)).fetchall()
+        return rows[0] if rows else None
+
+    def segments(self, session_id):
+        with self.lock:
+            return self._connect().execute(
+                "SELECT * FROM segments WHERE session_id = ? ORDER BY segment, path", (session_id,)).fetchall()
+
+    def speakers(self, session_id):
+        """セッションの話者ごとの受信バイト数"""
+        with self.lock:
+            return self._connect().execute(
+                "SELECT p.user_id, MAX(p.display_name) AS display_name, SUM(p.bytes) AS bytes "
+                "FROM speakers p JOIN segments g ON g.id = p.segment_id WHERE g.session_id = ? "
+                "GROUP BY p.user_id ORDER BY bytes DESC", (session_id,)).fetchall()
+
+catalog = RecordingCatalog(CATALOG_PATH or os.path.join(RECORDINGS_DIR, "catalog.sqlite3"))
+
+def segment_number(filename):
+    """segment_N で始まるファイル名からセグメント番号を取り出す（それ以外はNone）"""
+    match = re.match(r"segment_(\d+)", os.path.basename(filename))
+    return int(match.group(1)) if match else None
+
+async def record_segment(stream, filename, success):
+    """保存を終えたセグメントを目録に記録する"""
+    segment = segment_number(filename)
+    if segment is None:
+        return  # !test_record などセッション外のファイル
+    if stream.partial is not None:
+        status = "partial"
+    else:
+        status = "ok" if success else ("silent" if stream.is_silent else "failed")
+    display_names = resolve_display_names(stream.guild, stream.user_bytes)
+    speakers = []
+    for user, size in stream.user_bytes.items():
+        if user in stream.outputs:
+            track = stream.outputs[user][2].filename
+        elif user in stream.opus_tracks:
+            track = stream.opus_tracks[user][0].filename
+        else:
+            track = None
+        speakers.append((user, display_names.get(user), size, track))
+    
+    def write():
+        guild_id = stream.guild.id if stream.guild is not None else None
+        guild_name = stream.guild.name if stream.guild is not None else None
+        if stream.partial is not None:
+            # 変換できた前半と、ffmpegが落ちた後のWAVをそれぞれ記録する
+            for path, duration in stream.partial:
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                catalog.add_segment(os.path.dirname(filename), segment, path, status, duration, size, speakers,
+                                    guild_id=guild_id, guild_name=guild_name)
+            return
+        path = stream.saved_path or stream.output_path
+        files = [track for *_, track in speakers if track] if stream.multitrack else [path]
+        size = sum(os.path.getsize(file) for file in files if os.path.exists(file))
+        catalog.add_segment(os.path.dirname(filename), segment, path, status, stream.duration, size, speakers,
+                            guild_id=guild_id, guild_name=guild_name)
+    
+    await asyncio.get_running_loop().run_in_executor(None, write)
+
+def export_session(session_id, output=None):
+    """セッションのセグメントを再エンコードせずに1つのファイルへつなげる
+
+    ffmpegのconcatデマルチプレクサでストリームをコピーする。
+    (出力先, セグメント数, 長さ) を返す。ブロックするのでスレッドから呼ぶこと。
+    """
+    session = catalog.session(session_id)
+    if session is None:
+        raise ValueError(f"セッション {session_id} は目録にありません")
+    if session["multitrack"]:
+        raise ValueError("マルチトラックのセッションは書き出せません（トラックごとに開始位置が異なるため）")
+    segments = [row for row in catalog.segments(session_id) if row["status"] == "ok" and os.path.exists(row["path"])]
+    if not segments:
+        raise ValueError("書き出せるセグメントがありません")
+    extensions = sorted({os.path.splitext(row["path"])[1] for row in segments})
+    if len(extensions) > 1:
+        # 変換に失敗してWAVで保存したセグメントが混ざっている場合など
+        raise ValueError(f"形式の異なるセグメントが混ざっているため、再エンコードせずにはつなげません: {', '.join(extensions)}")
+    if output is None:
+        output = os.path.join(session["session_dir"], f"session_{session_id}{extensions[0]}")
+    
+    list_path = output + ".concat.txt"
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for row in segments:
+            path = os.path.abspath(row["path"]).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+    ffmpeg_cmd = [
+        ffmpeg_executable(),
+        '-hide_banner', '-loglevel', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-c', 'copy',  # 再エンコードしない
+        '-y', output
+    ]
+    logger.info(f"実行するFFmpegコマンド: {' '.join(ffmpeg_cmd)}")
+    try:
+        result = subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpegでの結合に失敗しました: {result.stderr.decode(errors='replace') or '不明なエラー'}")
+    return output, len(segments), sum(row["duration"] for row in segments)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def catalog_cli(argv):
+    """目録のコマンドライン操作（python bot.py list / python bot.py export <セッションID>）"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="bot.py", description="録音の目録を表示・書き出します")
+    commands_parser = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands_parser.add_parser("list", help="録音したセッションの一覧")
+    list_parser.add_argument("--guild", type=int, help="サーバーIDで絞り込む")
+    list_parser.add_argument("--limit", type=int, default=20)
+    export_parser = commands_parser.add_parser("export", help="セッションのセグメントを1つのファイルにつなげる")
+    export_parser.add_argument("session_id", type=int)
+    export_parser.add_argument("-o", "--output", help="出力先（省略時はセッションのディレクトリ）")
+    args = parser.parse_args(argv)
+    
+    if args.command == "list":
+        for row in catalog.sessions(args.guild, args.limit):
+            print(f"#{row['id']}  {row['started_at'] or '-'}  {row['guild_name'] or row['guild_id']} "
+                  f"#{row['channel_name'] or '-'}  {row['segments']}セグメント  {format_duration(row['duration'])}  "
+                  f"{row['size'] / 1024 ** 2:.1f}MB  {row['session_dir']}")
+        return 0
+    try:
+        output, count, duration = export_session(args.session_id, args.output)
+    except (ValueError, RuntimeError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 1
+    print(f"{count}セグメント（{format_duration(duration)}）を書き出しました: {output}")
+    return 0
+
 @bot.command(name='stop')
-async def stop_recording(ctx):
-    """録音を停止します"""
+async def stop_recording(ctx, guild_id: int = None):
+    """録音を停止します（ボットの所有者は `!stop <サーバーID>` で他のサーバーの録音も停止できます）"""
     try:
-        guild_id = ctx.guild.id
-        
-        if guild_id not in recording_sessions:
-            await ctx.send("現在録音していません。")
+        target = ctx.guild.id if guild_id is None else guild_id
+        if target != ctx.guild.id and not await bot.is_owner(ctx.author):
+            await ctx.send("他のサーバーの録音を停止できるのはボットの所有者だけです。")
             return
         
-        session = recording_sessions[guild_id]
-        session["running"] = False
-        
-        # 最後のセグメントを保存
-        last_segment = session["segment"]
-        last_filename = f"{session['session_dir']}/segment_{last_segment}.mp3"
-        try:
-            session["voice_client"].stop_recording()
-            # 最後のセグメントも保存
-            sink = session["voice_client"].sink
-            if sink:
-                success = await save_recording_as_mp3(sink, last_filename)
-                if success:
-                    await ctx.send(f"最終セグメント {last_segment} を保存しました。\n保存先: {last_filename}")
-                else:
-                    await ctx.send(f"最終セグメントの保存に失敗しました。ログを確認してください。")
-        except Exception as e:
-            logger.error(f"録音停止中にエラーが発生しました: {e}")
-        
-        # 切断
-        try:
-            await session["voice_client"].disconnect()
-        except Exception as e:
-            logger.error(f"切断中にエラーが発生しました: {e}")
-        
-        # セッション情報をクリア
-        del recording_sessions[guild_id]
+        if owns_guild(target):
+            stopped = await stop_session(target)
+        elif control_client is None:
+            await ctx.send("担当シャードに接続できません。")
+            return
+        else:
+            # 他のシャードが担当するサーバーはスーパーバイザー経由で停止を依頼する
+            result = await control_client.request("stop", guild_id=target)
+            if "error" in result:
+                await ctx.send(f"録音停止中にエラーが発生しました: {result['error']}")
+                return
+            stopped = result["stopped"]
         
+        if not stopped:
+            await ctx.send("現在録音していません。")
+            return
         await ctx.send("録音を停止しました。")
-        logger.info(f"{ctx.guild.name}の録音を停止しました")
         
     except Exception as e:
         logger.error(f"録音停止処理中にエラーが発生しました: {e}")
         await ctx.send(f"録音停止中にエラーが発生しました: {e}")
 
+async def stop_session(guild_id):
+    """録音を停止して最後のセグメントを変換キューに渡す（録音していない・停止中ならFalse）"""
+    session = recording_sessions.get(guild_id)
+    if session is None or not session.transition(RecordingSession.STOPPING):
+        return False
+    
+    # 最後のセグメントを保存
+    try:
+        if session.voice_client.recording:
+            session.voice_client.stop_recording()
+        # 変換完了を待たずに切断へ進む（結果は完了時に通知）
+        await submit_final_segment(session)
+    except Exception as e:
+        logger.error(f"録音停止中にエラーが発生しました: {e}")
+    
+    # 切断
+    try:
+        await session.voice_client.disconnect()
+    except Exception as e:
+        logger.error(f"切断中にエラーが発生しました: {e}")
+    
+    # セッション情報をクリア
+    recording_sessions.remove(session)
+    live = live_taps.pop(guild_id, None)
+    if live is not None:
+        live.close()
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, catalog.end_session, session.session_dir)
+    except Exception as e:
+        logger.error(f"目録への記録に失敗しました: {e}")
+    logger.info(f"{session.ctx.guild.name}の録音を停止しました")
+    return True
+
+@bot.command(name='debug')
+async def debug_capture(ctx, mode: str = None):
+    """このサーバーでデバッグ用WAVを保存するかを切り替えます（`!debug on` / `!debug off`）"""
+    if mode == 'on':
+        debug_capture_guilds.add(ctx.guild.id)
+    elif mode == 'off':
+        debug_capture_guilds.discard(ctx.guild.id)
+    elif mode is not None:
+        await ctx.send("使い方: `!debug on` または `!debug off`")
+        return
+    state = "有効" if debug_capture_enabled(ctx.guild.id) else "無効"
+    note = "（config.py の DEBUG_CAPTURE で全サーバー有効）" if DEBUG_CAPTURE else ""
+    await ctx.send(f"デバッグ用WAVの保存: {state}{note}\n"
+                   f"保存先: {DEBUG_DIR}（最大 {DEBUG_MAX_FILES} ファイル / {DEBUG_MAX_BYTES // 1024 ** 2} MB）")
+
 @bot.command(name='status')
 async def status(ctx):
     """現在の録音状態を表示します"""
     try:
-        if ctx.guild.id in recording_sessions:
-            session = recording_sessions[ctx.guild.id]
-            voice_channel = session["voice_client"].channel
-            segment = session["segment"]
-            session_dir = session["session_dir"]
+        loop = asyncio.get_running_loop()
+        session = recording_sessions.get(ctx.guild.id)
+        if session is not None:
+            # 保存済みのセグメントは目録から集計する
+            row = await loop.run_in_executor(None, lambda: catalog.session(session_dir=session.session_dir))
+            saved_text = (f"{row['segments']}セグメント, {format_duration(row['duration'])}, {row['size'] / 1024 ** 2:.1f}MB"
+                          if row is not None and row["segments"] else "なし")
+            voice_channel = session.voice_client.channel
+            segment = session.segment
+            session_dir = session.session_dir
+            losses = session.boundary_loss_ms
+            if losses:
+                dropped, shifted = losses[-1]
+                loss_text = (f"捨てた {dropped:.1f}ms・先頭に寄せた {shifted:.1f}ms"
+                             f"（累計 {sum(d for d, _ in losses):.1f}ms・{sum(s for _, s in losses):.1f}ms）")
+            else:
+                loss_text = "なし"
             
             # 接続中のユーザー情報を取得
-            members = voice_channel.members
-            member_names = [member.display_name for member in members if not member.bot]
+            member_names = await voice_member_names(voice_channel)
             
             await ctx.send(f"現在の録音状況:\n"
                           f"チャンネル: {voice_channel.name}\n"
-                          f"現在のセグメント: {segment}\n"
+                          f"現在のセグメント: {segment}（{session.state}）\n"
                           f"保存先: {session_dir}\n"
-                          f"参加者: {', '.join(member_names)}")
+                          f"参加者: {', '.join(member_names)}\n"
+                          f"保存済み: {saved_text}\n"
+                          f"区切りで失われた・ずれた音声: {loss_text}\n"
+                          f"{encode_queue.describe()}")
         else:
-            await ctx.send("現在録音していません。")
+            rows = await loop.run_in_executor(None, catalog.sessions, ctx.guild.id, 1)
+            last = (f"\n前回の録音: #{rows[0]['id']} {rows[0]['started_at'] or '-'}（{rows[0]['segments']}セグメント, "
+                    f"{format_duration(rows[0]['duration'])}）" if rows else "")
+            await ctx.send("現在録音していません。" + last)
     except Exception as e:
         logger.error(f"状態確認中にエラーが発生しました: {e}")
         await ctx.send(f"状態確認中にエラーが発生しました: {e}")
 
+@bot.command(name='metrics')
+async def show_metrics(ctx):
+    """このサーバーの録音に関するメトリクスを表示します"""
+    guild = str(ctx.guild.id)
+    samples = metrics.samples()
+    
+    def total(name, **labels):
+        labels["guild"] = guild
+        return sum(value for sample_name, sample_labels, value in samples
+                   if sample_name == name and labels.items() <= sample_labels.items())
+    
+    def average(name, **labels):
+        count, value_sum = metrics.histogram_summary(name, **labels)
+        return f"平均 {value_sum / count:.2f}秒（{count}件）" if count else "記録なし"
+    
+    lag = monitor_event_loop.lag
+    await ctx.send(f"メトリクス:\n"
+                   f"受信パケット: {total('recorder_packets_received_total'):.0f}"
+                   f"（破棄 {total('recorder_packets_dropped_total'):.0f}, "
+                   f"合成で捨てたフレーム {total('recorder_dropped_frames_total'):.0f}）\n"
+                   f"未出力のバッファ: {total('recorder_buffered_bytes') / 1024:.1f}KB"
+                   f"（確保 {total('recorder_sink_memory_bytes') / 1024 ** 2:.1f}MB）\n"
+                   f"{encode_queue.describe()}\n"
+                   f"{transcription_queue.describe()}"
+                   f"（成功 {total('recorder_transcriptions_total', result='success'):.0f}, "
+                   f"失敗 {total('recorder_transcriptions_total', result='failure'):.0f}, "
+                   f"スキップ {total('recorder_transcriptions_total', result='skipped'):.0f}）\n"
+                   f"キュー待ち: {average('recorder_encode_wait_seconds', guild=guild)}\n"
+                   f"エンコード: {average('recorder_encode_seconds', guild=guild)}\n"
+                   f"FFmpeg（全体）: 経過 {average('recorder_ffmpeg_wall_seconds')}, "
+                   f"CPU {average('recorder_ffmpeg_cpu_seconds')}\n"
+                   f"イベントループの遅れ: {f'{lag * 1000:.1f}ms' if lag is not None else '計測中'}\n"
+                   f"再接続: 成功 {total('recorder_reconnects_total', result='success'):.0f}, "
+                   f"失敗 {total('recorder_reconnects_total', result='failure'):.0f}")
+
+@bot.command(name='live')
+async def show_live(ctx):
+    """録音中のミックスを聴くためのURLを表示します"""
+    if LIVE_PORT is None:
+        await ctx.send("配信は無効です。config.py の LIVE_PORT を設定してください。")
+        return
+    if ctx.guild.id not in live_taps:
+        await ctx.send("このサーバーではミックスを録音していません（マルチトラック録音は配信できません）。")
+        return
+    if live_taps[ctx.guild.id].closed:
+        await ctx.send("エラーが発生したため、このセッションの配信は停止しています（録音は続いています）。")
+        return
+    await ctx.send(f"録音中のミックスを配信しています（{LIVE_BUFFER_SECONDS}秒ほど遅れます）:\n{live_url(ctx.guild.id)}")
+
+@bot.command(name='recordings')
+async def list_recordings(ctx, limit: int = 5):
+    """このサーバーで録音したセッションの一覧を表示します"""
+    rows = await asyncio.get_running_loop().run_in_executor(None, catalog.sessions, ctx.guild.id, min(limit, 20))
+    if not rows:
+        await ctx.send("録音したセッションはありません。")
+        return
+    active = {session.session_dir for session in recording_sessions.values()}
+    lines = ["録音したセッション（`!export <番号>` で1つのファイルにつなげられます）:"]
+    for row in rows:
+        lines.append(f"#{row['id']} {row['started_at'] or '-'} #{row['channel_name'] or '-'}: "
+                     f"{row['segments']}セグメント, {format_duration(row['duration'])}, "
+                     f"{row['size'] / 1024 ** 2:.1f}MB" + ("（録音中）" if row["session_dir"] in active else ""))
+    await ctx.send("\n".join(lines))
+
+@bot.command(name='export')
+async def export(ctx, session_id: int = None):
+    """セッションのセグメントを再エンコードせずに1つのファイルにつなげます（省略時は最新のセッション）"""
+    loop = asyncio.get_running_loop()
+    if session_id is None:
+        rows = await loop.run_in_executor(None, catalog.sessions, ctx.guild.id, 1)
+        if not rows:
+            await ctx.send("録音したセッションはありません。")
+            return
+        session_id = rows[0]["id"]
+    row = await loop.run_in_executor(None, catalog.session, session_id)
+    if row is None or row["guild_id"] != ctx.guild.id:
+        await ctx.send(f"セッション #{session_id} はこのサーバーの録音ではありません。")
+        return
+    
+    await ctx.send(f"セッション #{session_id} を書き出しています...")
+    try:
+        output, count, duration = await loop.run_in_executor(None, export_session, session_id)
+    except (ValueError, RuntimeError) as e:
+        await ctx.send(f"書き出しに失敗しました: {e}")
+        return
+    await ctx.send(f"{count}セグメント（{format_duration(duration)}）を1つのファイルにしました。\n保存先: {output}")
+
 @bot.command(name='test_record')
 async def test_record(ctx):
     """短い録音テストを実行します（30秒）"""
@@ -436,18 +3286,17 @@ async def test_record(ctx):
         await ctx.send(f"{voice_channel.name} でテスト録音を開始します（30秒）")
         
         # チャンネルのメンバー確認
-        members = voice_channel.members
-        member_names = [member.display_name for member in members if not member.bot]
+        member_names = await voice_member_names(voice_channel)
         await ctx.send(f"録音対象ユーザー: {', '.join(member_names)}")
         
         # テスト用ディレクトリ
         test_dir = os.path.join(RECORDINGS_DIR, "test")
         os.makedirs(test_dir, exist_ok=True)
-        test_file = os.path.join(test_dir, f"test_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3")
+        test_file = os.path.join(test_dir, f"test_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}{OUTPUT_EXT}")
         
         # 接続して録音
-        voice_client = await voice_channel.connect()
-        sink = discord.sinks.WaveSink()
+        voice_client = await voice_channel.connect(cls=RecorderVoiceClient)
+        sink = StreamingSink(test_file, guild=ctx.guild)
         voice_client.start_recording(sink, finished_callback, ctx)
         
         await ctx.send("録音中... 30秒お待ちください")
@@ -455,8 +3304,9 @@ async def test_record(ctx):
         
         # 録音停止と保存
         voice_client.stop_recording()
-        success = await save_recording_as_mp3(sink, test_file)
+        job = await encode_queue.submit(sink.stream, test_file, f"{ctx.guild.name} テスト録音")
         await voice_client.disconnect()
+        success = await job.future
         
         # 結果確認
         if success and os.path.exists(test_file):
@@ -464,18 +3314,15 @@ async def test_record(ctx):
             await ctx.send(f"テスト録音完了！ファイルサイズ: {size} バイト\n保存先: {test_file}")
             
             # 録音ユーザー数の報告
-            if sink.audio_data:
-                user_count = len(sink.audio_data)
+            if sink.stream.user_bytes:
+                user_count = len(sink.stream.user_bytes)
                 await ctx.send(f"録音されたユーザー数: {user_count}")
                 
-                # 各ユーザーのデータサイズを報告
-                for user_id, audio in sink.audio_data.items():
-                    audio.file.seek(0, os.SEEK_END)
-                    size = audio.file.tell()
-                    audio.file.seek(0)
-                    user = ctx.guild.get_member(int(user_id))
-                    user_name = user.display_name if user else f"不明なユーザー({user_id})"
-                    await ctx.send(f"- {user_name}: {size} バイト")
+                # 各ユーザーのデータサイズを報告（まとめて1つの埋め込みで送る）
+                display_names = await fetch_display_names(ctx.guild, sink.stream.user_bytes)
+                for user_id, size in sink.stream.user_bytes.items():
+                    user_name = display_names[user_id] or f"不明なユーザー({user_id})"
+                    notifications.notify(ctx.channel, f"- {user_name}: {size} バイト")
             else:
                 await ctx.send("音声データが取得できませんでした。音声が出ていることを確認してください。")
         else:
@@ -485,20 +3332,347 @@ async def test_record(ctx):
         logger.error(f"テスト録音中にエラーが発生しました: {e}")
         await ctx.send(f"テスト録音中にエラーが発生しました: {e}")
 
+# --- シャーディング（SHARD_COUNT > 1 のとき、サーバーを複数の録音プロセスで分担する） ---
+
+def shard_for_guild(guild_id, shard_count=None):
+    """サーバーを担当するシャード番号（Discordのシャーディングと同じ割り当て）"""
+    return (guild_id >> 22) % (shard_count or SHARD_COUNT)
+
+def owns_guild(guild_id):
+    """このプロセスが担当するサーバーか"""
+    return SHARD_ID is None or shard_for_guild(guild_id) == SHARD_ID
+
+def current_rss_mb():
+    """このプロセスの使用メモリ（RSS, MB）。取得できない環境ではNone"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+control_client = None  # スーパーバイザーとの制御チャネル（ワーカーとして動いているときだけ）
+
+class ControlClient:
+    """スーパーバイザーとの制御チャネル（ワーカー側）
+
+    受信はスレッドで待ち受け、要求への応答やスーパーバイザーからの指示は
+    イベントループに渡して処理する。
+    """
+
+    def __init__(self, address, authkey, loop):
+        self.conn = Client(address, authkey=authkey)
+        self.loop = loop
+        self.send_lock = threading.Lock()
+        self.pending = {}  # 応答待ちの要求
+        self._ids = itertools.count(1)
+        self.send({"type": "hello", "shard": SHARD_ID, "pid": os.getpid()})
+        threading.Thread(target=self._reader, name="control", daemon=True).start()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    async def request(self, op, timeout=15, **params):
+        """スーパーバイザーに要求を送り、応答を待つ"""
+        request_id = next(self._ids)
+        future = self.loop.create_future()
+        self.pending[request_id] = future
+        try:
+            self.send({"type": "request", "id": request_id, "op": op, **params})
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def _reader(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # 録音は続ける（報告と他シャードへの依頼だけができなくなる）
+                logger.error("スーパーバイザーとの接続が切れました")
+                return
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+
+    def _dispatch(self, message):
+        if message["type"] == "response":
+            future = self.pending.get(message["id"])
+            if future is not None and not future.done():
+                future.set_result(message["result"])
+        elif message["type"] == "command":
+            asyncio.create_task(self._run_command(message))
+
+    async def _run_command(self, message):
+        """他のシャードから転送された指示を実行する"""
+        try:
+            if message["op"] == "stop":
+                result = {"stopped": await stop_session(message["guild_id"])}
+            else:
+                result = {"error": f"不明な指示です: {message['op']}"}
+        except Exception as e:
+            logger.error(f"転送された指示の実行中にエラーが発生しました: {e}")
+            result = {"error": str(e)}
+        self.send({"type": "command_result", "id": message["id"], "result": result})
+
+def connect_control_channel():
+    """スーパーバイザーに接続して状態報告を始める（on_readyから呼ばれる）"""
+    global control_client
+    if control_client is None:
+        host, port = os.environ["RECORDER_CONTROL_ADDRESS"].rsplit(":", 1)
+        try:
+            control_client = ControlClient((host, int(port)), bytes.fromhex(os.environ["RECORDER_CONTROL_KEY"]),
+                                           asyncio.get_running_loop())
+            logger.info(f"スーパーバイザーに接続しました（シャード {SHARD_ID}/{SHARD_COUNT}）")
+        except Exception as e:
+            logger.error(f"スーパーバイザーに接続できませんでした: {e}")
+            return
+    if not report_health.is_running():
+        report_health.start()
+
+def health_report():
+    """スーパーバイザーに送る状態報告"""
+    sessions = {}
+    for session in recording_sessions.values():
+        voice_client = session.voice_client
+        sessions[session.guild_id] = {
+            "guild": session.ctx.guild.name,
+            "channel": voice_client.channel.name if voice_client.channel else None,
+            "segment": session.segment,
+            "state": session.state,
+            "multitrack": session.multitrack,
+            "connected": voice_client.is_connected(),
+        }
+    return {
+        "shard": SHARD_ID,
+        "pid": os.getpid(),
+        "sessions": sessions,
+        "encode": encode_queue.describe(),
+        "rss_mb": current_rss_mb(),
+        "latency_ms": bot.latency * 1000 if bot.is_ready() else None,
+        "loop_lag_ms": monitor_event_loop.lag * 1000 if monitor_event_loop.lag is not None else None,
+    }
+
+@tasks.loop(seconds=HEALTH_REPORT_INTERVAL)
+async def report_health():
+    """定期的に状態をスーパーバイザーへ報告する"""
+    try:
+        control_client.send({"type": "report", "report": health_report()})
+    except Exception as e:
+        logger.error(f"状態報告に失敗しました: {e}")
+
+class ShardSupervisor:
+    """SHARD_COUNT 個の録音プロセス（ワーカー）を起動・監視する親プロセス
+
+    各ワーカーは担当シャードとしてDiscordに接続し、担当サーバーの録音だけを扱う。
+    ワーカーは制御チャネル経由で状態を報告し、他のシャード宛ての依頼
+    （!stop <サーバーID>）はここで担当ワーカーへ転送する。
+    """
+
+    STABLE_SECONDS = 300  # これだけ動き続けたワーカーは、再起動の回数を数え直す
+
+    def __init__(self, shard_count):
+        self.shard_count = shard_count
+        self.authkey = os.urandom(16)
+        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        self.lock = threading.Lock()
+        self.processes = {}  # シャード -> Popen
+        self.restarts = {}  # シャード -> 再起動回数
+        self.restart_at = {}  # シャード -> 再起動する時刻
+        self.started_at = {}  # シャード -> 起動した時刻
+        self.connections = {}  # シャード -> (接続, 送信用ロック)
+        self.reports = {}  # シャード -> (受信時刻, 状態報告)
+        self.forwarded = {}  # 転送中の依頼 -> (依頼元シャード, 依頼ID)
+        self._ids = itertools.count(1)
+
+    def run(self):
+        logger.info(f"{self.shard_count}個の録音プロセスを起動します")
+        threading.Thread(target=self._accept, name="control-accept", daemon=True).start()
+        for shard in range(self.shard_count):
+            self.restarts[shard] = 0
+            self._spawn(shard)
+        try:
+            while True:
+                self._check_processes()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("録音プロセスを停止します")
+        finally:
+            for process in self.processes.values():
+                if process.poll() is None:
+                    process.terminate()
+            for process in self.processes.values():
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def _spawn(self, shard):
+        host, port = self.listener.address
+        env = dict(os.environ,
+                   RECORDER_SHARD_ID=str(shard),
+                   RECORDER_CONTROL_ADDRESS=f"{host}:{port}",
+                   RECORDER_CONTROL_KEY=self.authkey.hex())
+        self.processes[shard] = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                                 env=env, cwd=SCRIPT_DIR)
+        self.started_at[shard] = time.monotonic()
+        logger.info(f"シャード {shard} を起動しました (PID {self.processes[shard].pid})")
+
+    def _check_processes(self):
+        """終了したワーカーを間隔を空けて再起動する"""
+        now = time.monotonic()
+        for shard, process in list(self.processes.items()):
+            if process.poll() is None:
+                # しばらく動き続けたら、再起動の間隔を最初からにする
+                if self.restarts[shard] and now - self.started_at[shard] >= self.STABLE_SECONDS:
+                    self.restarts[shard] = 0
+                continue
+            if shard not in self.restart_at:
+                delay = min(60, 2 ** self.restarts[shard])
+                self.restart_at[shard] = now + delay
+                logger.error(f"シャード {shard} が終了しました（終了コード {process.returncode}）。{delay}秒後に再起動します")
+            elif now >= self.restart_at[shard]:
+                del self.restart_at[shard]
+                self.restarts[shard] += 1
+                self._spawn(shard)
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                logger.error(f"制御チャネルの接続を受け付けられませんでした: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _send(self, shard, message):
+        with self.lock:
+            entry = self.connections.get(shard)
+        if entry is None:
+            return False
+        conn, send_lock = entry
+        try:
+            with send_lock:
+                conn.send(message)
+            return True
+        except OSError:
+            return False
+
+    def _serve(self, conn):
+        try:
+            hello = conn.recv()
+        except (EOFError, OSError):
+            return
+        shard = hello["shard"]
+        with self.lock:
+            self.connections[shard] = (conn, threading.Lock())
+        logger.info(f"シャード {shard} が制御チャネルに接続しました (PID {hello['pid']})")
+        try:
+            while True:
+                self._handle(shard, conn.recv())
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                if self.connections.get(shard, (None,))[0] is conn:
+                    del self.connections[shard]
+            conn.close()
+
+    def _handle(self, shard, message):
+        if message["type"] == "report":
+            with self.lock:
+                self.reports[shard] = (time.monotonic(), message["report"])
+        elif message["type"] == "request":
+            if message["op"] == "status":
+                self._send(shard, {"type": "response", "id": message["id"], "result": self.snapshot()})
+            elif message["op"] == "stop":
+                target = shard_for_guild(message["guild_id"], self.shard_count)
+                command_id = next(self._ids)
+                with self.lock:
+                    self.forwarded[command_id] = (shard, message["id"])
+                if not self._send(target, {"type": "command", "id": command_id, "op": "stop",
+                                           "guild_id": message["guild_id"]}):
+                    with self.lock:
+                        self.forwarded.pop(command_id, None)
+                    self._send(shard, {"type": "response", "id": message["id"],
+                                       "result": {"error": f"シャード {target} に接続できません"}})
+        elif message["type"] == "command_result":
+            with self.lock:
+                origin = self.forwarded.pop(message["id"], None)
+            if origin is not None:
+                self._send(origin[0], {"type": "response", "id": origin[1], "result": message["result"]})
+
+    def snapshot(self):
+        """全シャードの状態（!shards 用）"""
+        now = time.monotonic()
+        result = []
+        with self.lock:
+            for shard, process in sorted(self.processes.items()):
+                received, report = self.reports.get(shard, (None, {}))
+                result.append({
+                    "shard": shard,
+                    "pid": process.pid,
+                    "alive": process.poll() is None,
+                    "connected": shard in self.connections,
+                    "restarts": self.restarts[shard],
+                    "report_age": None if received is None else now - received,
+                    "report": report,
+                })
+        return result
+
+@bot.command(name='shards')
+@commands.is_owner()
+async def shards(ctx):
+    """各シャード（録音プロセス）の状態を表示します（ボットの所有者のみ）"""
+    if SHARD_ID is None:
+        await ctx.send("シャーディングは無効です（SHARD_COUNT = 1）。")
+        return
+    if control_client is None:
+        await ctx.send("スーパーバイザーに接続できていません。")
+        return
+    
+    lines = []
+    for entry in await control_client.request("status"):
+        report = entry["report"]
+        if not entry["alive"]:
+            state = "停止中"
+        elif entry["report_age"] is None:
+            state = "起動中"
+        elif entry["report_age"] > HEALTH_REPORT_INTERVAL * 3:
+            state = f"応答なし（最終報告 {entry['report_age']:.0f}秒前）"
+        else:
+            state = "稼働中"
+        details = [f"再起動 {entry['restarts']}回"]
+        if report:
+            details.append(f"録音 {len(report['sessions'])}件")
+            details.append(report["encode"])
+            if report["rss_mb"] is not None:
+                details.append(f"メモリ {report['rss_mb']:.0f}MB")
+            if report["latency_ms"] is not None:
+                details.append(f"遅延 {report['latency_ms']:.0f}ms")
+            if report["loop_lag_ms"] is not None:
+                details.append(f"ループ遅延 {report['loop_lag_ms']:.1f}ms")
+        lines.append(f"シャード {entry['shard']} (PID {entry['pid']}): {state} / " + " / ".join(details))
+        for guild_id, session in report.get("sessions", {}).items():
+            mode = "マルチトラック" if session["multitrack"] else "ミックス"
+            lines.append(f"  - {session['guild']} ({guild_id}) #{session['channel']}: "
+                         f"セグメント {session['segment']}, {mode}, {session['state']}")
+    await ctx.send("\n".join(lines))
+
 # ボットを実行
 if __name__ == "__main__":
+    # 目録の操作（python bot.py list / export）はボットを起動せずに実行する
+    if sys.argv[1:2] in (["list"], ["export"]):
+        sys.exit(catalog_cli(sys.argv[1:]))
+    
     # recordingsディレクトリの作成
     os.makedirs(RECORDINGS_DIR, exist_ok=True)
-    logger.info("ボットを起動しています...")
     
-    # FFmpegが利用可能か確認
-    try:
-        ffmpeg_command = FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else 'ffmpeg'
-        subprocess.run([ffmpeg_command, '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logger.info("FFmpegが利用可能です")
-    except Exception as e:
-        logger.warning(f"FFmpegが見つかりません。MP3変換ができない可能性があります: {e}")
-        print("警告: FFmpegが見つかりません。MP3変換には FFmpeg のインストールが必要です。")
+    # 複数シャードの場合はこのプロセスがスーパーバイザーになり、各シャードを別プロセスで起動する
+    if SHARD_COUNT > 1 and SHARD_ID is None:
+        ShardSupervisor(SHARD_COUNT).run()
+        sys.exit(0)
+    
+    # FFmpegの確認はログイン後に非同期で行う（probe_ffmpeg）
+    logger.info("ボットを起動しています...")
     
     try:
         bot.run(TOKEN)